@@ -0,0 +1,529 @@
+# benchmarks/load_test.py
+"""
+Нагрузочный тест бота целиком: настоящий Dispatcher со всеми роутерами и
+middleware, настоящий планировщик и пул бэкендов, но вместо Telegram - сессия,
+которая сразу отвечает на запросы, а вместо A1111 - заглушки tools/a1111_stub.py.
+
+Каждый виртуальный пользователь проходит сценарий /generate -> выбор персонажа ->
+настройки (модель) -> ввод промта -> генерация, нажимая кнопки из клавиатур,
+которые ему прислал бот. В конце печатаются p50/p95/p99 времени обработки
+апдейтов по шагам, число изображений в секунду и задержки event loop.
+
+    python benchmarks/load_test.py --users 2000 --concurrency 300 --backends 4 --gen-latency 0.2
+    python benchmarks/load_test.py --output results.json
+    python benchmarks/load_test.py --baseline results.json --tolerance 0.2
+
+Скрипт завершается с кодом 1, если не доставлено ни одного изображения или
+перекодирование давало сбои, а с --baseline - еще и если p95 или число
+изображений в секунду ухудшились больше допустимого. Данные пользователей, FSM и кэши пишутся
+во временную папку, рабочие файлы бота в data/ не затрагиваются.
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import BufferedInputFile, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
+
+BASE_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+BOT_TOKEN = "123456789:LOADTEST"
+BOT_USER = {"id": 123456789, "is_bot": True, "first_name": "LoadTestBot", "username": "load_test_bot"}
+FIRST_USER_ID = 10_000_000
+
+# Методы, в ответ на которые Telegram возвращает сообщение
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "editMessageText",
+    "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia",
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Сводка по выборке в миллисекундах."""
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50) * 1000,
+        "p95": percentile(values, 0.95) * 1000,
+        "p99": percentile(values, 0.99) * 1000,
+        "max": max(values) * 1000 if values else 0.0,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Сессия бота без сети: ответ на каждый метод собирается на месте и проходит
+    через тот же разбор, что и настоящий ответ Telegram. Запоминает последнюю
+    клавиатуру в каждом чате, чтобы виртуальные пользователи могли жать кнопки.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        # chat_id -> (message_id, клавиатура) последнего сообщения с inline-кнопками
+        self.keyboards: Dict[int, Tuple[int, InlineKeyboardMarkup]] = {}
+        # chat_id -> событие "в чат пришло изображение"
+        self.image_events: Dict[int, asyncio.Event] = defaultdict(asyncio.Event)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.images = 0
+        self.uploaded_bytes = 0
+
+    def _count_upload(self, media: Any):
+        if isinstance(media, BufferedInputFile):
+            self.uploaded_bytes += len(media.data)
+        elif isinstance(media, FSInputFile):
+            self.uploaded_bytes += os.path.getsize(media.path)
+
+    def _message(self, chat_id: int, message_id: Optional[int] = None, **fields) -> dict:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _media_fields(self, kind: str, media: Any) -> dict:
+        self._count_upload(media)
+        file_id = media if isinstance(media, str) else f"file{next(self._file_ids)}"
+        if kind == "photo":
+            return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 768}]}
+        return {"document": {"file_id": file_id, "file_unique_id": file_id}}
+
+    def _result(self, method: TelegramMethod) -> Any:
+        name = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+        if name == "sendMediaGroup":
+            self.images += len(method.media)
+            self.image_events[chat_id].set()
+            return [self._message(chat_id, **self._media_fields(item.type, item.media)) for item in method.media]
+        if name not in MESSAGE_METHODS:
+            if name == "getChatMember":
+                return {"status": "member", "user": {"id": method.user_id, "is_bot": False, "first_name": "user"}}
+            return True
+
+        fields = {"text": getattr(method, "text", None) or "..."}
+        if name == "sendPhoto":
+            fields = self._media_fields("photo", method.photo)
+        elif name == "sendDocument":
+            fields = self._media_fields("document", method.document)
+        if name in ("sendPhoto", "sendDocument"):
+            self.images += 1
+            self.image_events[chat_id].set()
+        message = self._message(chat_id, getattr(method, "message_id", None), **fields)
+        if isinstance(getattr(method, "reply_markup", None), InlineKeyboardMarkup):
+            self.keyboards[chat_id] = (message["message_id"], method.reply_markup)
+        return message
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        self.calls[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = json.dumps({"ok": True, "result": self._result(method)})
+        response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+        return response.result
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def find_buttons(self, chat_id: int, prefix: str) -> Tuple[Optional[int], List[InlineKeyboardButton]]:
+        """message_id и кнопки последней клавиатуры чата, callback_data которых начинается с prefix."""
+        message_id, markup = self.keyboards.get(chat_id, (None, None))
+        if markup is None:
+            return None, []
+        return message_id, [button for row in markup.inline_keyboard for button in row
+                            if button.callback_data and button.callback_data.startswith(prefix)]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, dp, bot: Bot, session: FakeTelegramSession):
+        self.args = args
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self._update_ids = itertools.count(1)
+        # Шаг сценария -> время обработки апдейтов, с
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.loop_lag: List[float] = []
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.completed_users = 0
+
+    async def _feed(self, step: str, update: dict):
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_raw_update(self.bot, {"update_id": next(self._update_ids), **update})
+        except Exception as e:
+            self.errors[f"{step}: {type(e).__name__}"] += 1
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def send_text(self, step: str, user_id: int, text: str):
+        await self._feed(step, {"message": {
+            "message_id": random.randint(1, 2 ** 31), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        }})
+
+    async def press(self, step: str, user_id: int, prefix: str, choose_random: bool = False) -> bool:
+        message_id, buttons = self.session.find_buttons(user_id, prefix)
+        if not buttons:
+            self.errors[f"{step}: нет кнопки {prefix}"] += 1
+            return False
+        data = (random.choice(buttons) if choose_random else buttons[0]).callback_data
+        await self._feed(step, {"callback_query": {
+            "id": str(next(self._update_ids)), "chat_instance": str(user_id), "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "message": {"message_id": message_id, "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "..."},
+        }})
+        return True
+
+    async def think(self):
+        if self.args.think_time:
+            await asyncio.sleep(random.uniform(0, self.args.think_time))
+
+    async def run_user(self, user_id: int):
+        """Сценарий одного пользователя: /generate -> персонаж -> модель -> промт -> генерация."""
+        await self.send_text("generate_command", user_id, "/generate")
+        await self.think()
+        if not await self.press("toggle_character", user_id, "toggle_char_", choose_random=True):
+            return
+        await self.think()
+        if not await self.press("characters_done", user_id, "chars_done"):
+            return
+        await self.think()
+        # Модель сохраняется в профиле: при повторном запуске шаг выбора пропускается
+        _, model_buttons = self.session.find_buttons(user_id, "edit_setting_model_name")
+        if model_buttons and model_buttons[0].text.endswith("Не выбрана"):
+            await self.press("model_menu", user_id, "edit_setting_model_name")
+            await self.think()
+            if not await self.press("select_model", user_id, "set_model_", choose_random=True):
+                return
+            await self.think()
+        if not await self.press("settings_done", user_id, "settings_done"):
+            return
+        await self.think()
+        await self.send_text("enter_prompt", user_id, f"masterpiece, best quality, scene {random.randint(1, 50)}")
+        await self.think()
+
+        delivered = self.session.image_events[user_id]
+        delivered.clear()
+        if self.args.generate_all:
+            if not await self.press("generate_all", user_id, "generate_all"):
+                return
+        elif not await self.press("generate_image", user_id, "generate_img_"):
+            return
+        # Сценарий считается пройденным, когда в чат пришло первое изображение
+        try:
+            await asyncio.wait_for(delivered.wait(), timeout=self.args.user_timeout)
+            self.completed_users += 1
+        except asyncio.TimeoutError:
+            self.errors["изображение не пришло"] += 1
+
+    async def monitor_loop_lag(self, interval: float = 0.05):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - started - interval)
+
+    async def run(self) -> Dict[str, Any]:
+        from bot.handlers import user_handlers
+
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(user_id: int):
+            async with semaphore:
+                await self.run_user(user_id)
+
+        monitor = asyncio.create_task(self.monitor_loop_lag())
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(FIRST_USER_ID + i) for i in range(self.args.users)))
+        # Пакетная генерация (generate_all) доставляется фоновыми задачами
+        while user_handlers._background_tasks:
+            await asyncio.wait(set(user_handlers._background_tasks))
+        elapsed = time.perf_counter() - started
+        monitor.cancel()
+
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        return {
+            "users": self.args.users,
+            "completed_users": self.completed_users,
+            "elapsed": elapsed,
+            "updates": len(all_latencies),
+            "updates_per_second": len(all_latencies) / elapsed,
+            "images": self.session.images,
+            "images_per_second": self.session.images / elapsed,
+            "uploaded_bytes": self.session.uploaded_bytes,
+            "handler_latency": summarize(all_latencies),
+            "steps": {step: summarize(values) for step, values in self.latencies.items()},
+            "loop_lag": summarize(self.loop_lag),
+            "telegram_calls": dict(self.session.calls),
+            "errors": dict(self.errors),
+        }
+
+
+def setup_config(args: argparse.Namespace, workdir: Path, backend_urls: List[str]):
+    """
+    Подставляет config для прогона: настоящий config.py (если есть) с адресами
+    заглушек и путями во временной папке, иначе минимальный config.py во временной
+    папке. Он лежит на sys.path, поэтому его импортируют и процессы перекодирования.
+    """
+    try:
+        import config
+    except ImportError:
+        (workdir / "config.py").write_text(f"A1111_API_URL = {backend_urls[0]!r}\n", encoding="utf-8")
+        sys.path.insert(0, str(workdir))
+        importlib.invalidate_caches()
+        import config
+    # Каталог моделей и семплеров тоже должен опрашивать заглушки, а не рабочий A1111
+    config.A1111_API_URL = backend_urls[0]
+    config.BOT_TOKEN = BOT_TOKEN
+    config.ADMIN_IDS = []
+    config.A1111_BACKENDS = backend_urls
+    config.A1111_CONCURRENCY = 1
+    config.USER_DB_PATH = workdir / "users.db"
+    config.IMAGE_CACHE_DIR = workdir / "image_cache"
+    config.FSM_STORAGE = args.fsm
+    config.FSM_DB_PATH = workdir / "fsm.db"
+    config.MAX_CONCURRENT_UPDATES = args.max_concurrent_updates
+    config.PROGRESS_POLL_INTERVAL = args.progress_interval
+
+
+def isolate_data_files(workdir: Path):
+    """Настройки бота и кэш file_id читаются и пишутся во временной папке."""
+    from bot.delivery import file_id_cache
+    from services import settings_service
+
+    settings_path = workdir / "settings.json"
+    if settings_service.SETTINGS_FILE.exists():
+        shutil.copyfile(settings_service.SETTINGS_FILE, settings_path)
+    settings_service.SETTINGS_FILE = settings_path
+    file_id_cache.path = workdir / "telegram_file_ids.json"
+
+    settings = settings_service.load_settings()
+    # Все виртуальные пользователи проходят проверки доступа и не упираются в лимит промтов
+    settings["bot_status"] = "active"
+    settings["required_channel_id"] = None
+    settings["generation_limit_default"] = 10 ** 6
+
+
+async def start_stubs(args: argparse.Namespace) -> Tuple[List[str], List[asyncio.subprocess.Process]]:
+    """Запускает заглушки A1111 отдельными процессами, чтобы они не делили event loop с ботом."""
+    if args.backend_url:
+        return args.backend_url, []
+
+    stub_args = [
+        "--latency", str(args.gen_latency),
+        "--model-switch-delay", str(args.model_switch_delay),
+        "--image-scale", str(args.image_scale),
+        "--failure-rate", str(args.failure_rate),
+    ]
+    for value in args.endpoint_latency:
+        stub_args += ["--endpoint-latency", value]
+    if args.noise:
+        stub_args.append("--noise")
+
+    urls, processes = [], []
+    for _ in range(args.backends):
+        port = free_port()
+        processes.append(await asyncio.create_subprocess_exec(
+            sys.executable, str(BASE_DIR / "tools" / "a1111_stub.py"), "--port", str(port), *stub_args,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        ))
+        urls.append(f"http://127.0.0.1:{port}")
+
+    async with aiohttp.ClientSession() as http:
+        for url in urls:
+            for _ in range(100):
+                try:
+                    async with http.get(f"{url}/stub/stats") as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError(f"Заглушка A1111 {url} не запустилась")
+    return urls, processes
+
+
+async def collect_stub_stats(urls: List[str]) -> Dict[str, Any]:
+    stats = {}
+    async with aiohttp.ClientSession() as http:
+        for url in urls:
+            try:
+                async with http.get(f"{url}/stub/stats") as response:
+                    stats[url] = await response.json()
+            except aiohttp.ClientError:
+                pass
+    return stats
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\nПользователей: {report['users']}, дошли до изображения: {report['completed_users']}")
+    print(f"Время прогона: {report['elapsed']:.1f} с, апдейтов: {report['updates']} "
+          f"({report['updates_per_second']:.0f}/с)")
+    print(f"Изображений: {report['images']} ({report['images_per_second']:.2f}/с), "
+          f"загружено {report['uploaded_bytes'] / 1024 / 1024:.1f} МБ")
+
+    print(f"\n{'Шаг':<20}{'кол-во':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (мс)")
+    rows = list(report["steps"].items()) + [("ВСЕ АПДЕЙТЫ", report["handler_latency"]), ("задержка loop", report["loop_lag"])]
+    for name, stats in rows:
+        print(f"{name:<20}{stats['count']:>8}{stats['p50']:>10.1f}{stats['p95']:>10.1f}"
+              f"{stats['p99']:>10.1f}{stats['max']:>10.1f}")
+
+    for url, stats in report.get("stubs", {}).items():
+        print(f"\n{url}: генераций {stats['generations']}, смен модели {stats['model_switches']}, "
+              f"ошибок {stats['failures']}")
+    if any(report["image_errors"].values()):
+        print("\nСбои обработки изображений: " + ", ".join(
+            f"{operation} {count}" for operation, count in report["image_errors"].items()))
+    if report["errors"]:
+        print("\nОшибки:")
+        for name, count in sorted(report["errors"].items(), key=lambda item: -item[1]):
+            print(f"  {count:>6}  {name}")
+
+
+def check_pipeline(report: Dict[str, Any]) -> List[str]:
+    """Прогон без изображений или со сбоями перекодирования измеряет не тот путь доставки."""
+    problems = []
+    if not report["images"]:
+        problems.append("не доставлено ни одного изображения")
+    failed = {operation: count for operation, count in report["image_errors"].items() if count}
+    if failed:
+        problems.append("сбои обработки изображений: " + ", ".join(f"{op} {count}" for op, count in failed.items()))
+    return problems
+
+
+def check_regression(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Сравнивает прогон с сохраненным: p95 и p99 не должны вырасти, а изображений/с - упасть больше tolerance."""
+    problems = []
+    for key in ("p95", "p99"):
+        old, new = baseline["handler_latency"][key], report["handler_latency"][key]
+        if old and new > old * (1 + tolerance):
+            problems.append(f"{key} времени обработки: {old:.1f} -> {new:.1f} мс")
+    old, new = baseline["images_per_second"], report["images_per_second"]
+    if old and new < old * (1 - tolerance):
+        problems.append(f"изображений в секунду: {old:.2f} -> {new:.2f}")
+    return problems
+
+
+async def run(args: argparse.Namespace) -> int:
+    random.seed(args.seed)
+    workdir = Path(tempfile.mkdtemp(prefix="bot_load_test_"))
+    backend_urls, processes = await start_stubs(args)
+    try:
+        setup_config(args, workdir, backend_urls)
+        isolate_data_files(workdir)
+        from bot.throttling import outbound_throttle
+        from main import create_dispatcher
+        from services import image_processing
+
+        session = FakeTelegramSession(latency=args.telegram_latency)
+        if args.throttle:
+            session.middleware(outbound_throttle)
+        bot = Bot(token=BOT_TOKEN, session=session)
+        dp = create_dispatcher()
+
+        await dp.emit_startup(bot=bot)
+        try:
+            report = await LoadTest(args, dp, bot, session).run()
+            report["image_errors"] = dict(image_processing.stats)
+        finally:
+            await dp.emit_shutdown(bot=bot)
+        report["stubs"] = await collect_stub_stats(backend_urls)
+    finally:
+        for process in processes:
+            process.terminate()
+            await process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    problems = check_pipeline(report)
+    if problems:
+        print("\nПрогон недействителен, цифры выше не отражают рабочий путь:")
+        for problem in problems:
+            print("  " + problem)
+        return 1
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        problems = check_regression(report, baseline, args.tolerance)
+        if problems:
+            print("\nРегрессия относительно", args.baseline)
+            for problem in problems:
+                print("  " + problem)
+            return 1
+        print(f"\nРегрессий относительно {args.baseline} нет.")
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Telegram и A1111")
+    parser.add_argument("--users", type=int, default=1000, help="число виртуальных пользователей")
+    parser.add_argument("--concurrency", type=int, default=200, help="сколько пользователей активны одновременно")
+    parser.add_argument("--think-time", type=float, default=0.2, help="пауза пользователя между шагами (до), с")
+    parser.add_argument("--generate-all", action="store_true", help="генерировать все варианты промта вместо одного")
+    parser.add_argument("--user-timeout", type=float, default=600, help="сколько пользователь ждет изображение, с")
+    parser.add_argument("--seed", type=int, default=1)
+
+    parser.add_argument("--backends", type=int, default=4, help="число заглушек A1111")
+    parser.add_argument("--backend-url", action="append", default=[], help="готовый сервер A1111 вместо заглушек")
+    parser.add_argument("--gen-latency", type=float, default=0.2, help="время генерации на заглушке, с")
+    parser.add_argument("--endpoint-latency", action="append", default=[], metavar="NAME=SECONDS",
+                        help="задержка эндпоинта заглушки, например options=0.05")
+    parser.add_argument("--model-switch-delay", type=float, default=0.5, help="время смены чекпоинта, с")
+    parser.add_argument("--image-scale", type=float, default=1 / 8, help="размер картинки относительно запрошенного")
+    parser.add_argument("--noise", action="store_true", help="несжимаемые картинки реалистичного размера")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="доля txt2img с ошибкой 500")
+
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа Telegram API, с")
+    parser.add_argument("--throttle", action="store_true", help="включить ограничитель скорости отправки Telegram")
+    parser.add_argument("--fsm", choices=("memory", "sqlite"), default="memory", help="хранилище FSM")
+    parser.add_argument("--max-concurrent-updates", type=int, default=100,
+                        help="предел одновременно обрабатываемых апдейтов (MAX_CONCURRENT_UPDATES)")
+    parser.add_argument("--progress-interval", type=float, default=1.0, help="период опроса прогресса A1111, с")
+
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для проверки на регрессию")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение относительно baseline")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
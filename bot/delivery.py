@@ -0,0 +1,312 @@
+# bot/delivery.py
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    BufferedInputFile, FSInputFile, InlineKeyboardMarkup, InputFile, InputMediaDocument, InputMediaPhoto
+)
+
+import config
+from services import metrics
+from services.a1111_api_service import GenerationResult
+from services.image_processing import prepare_photo, prepare_thumbnail, transcoding_enabled
+
+BASE_DIR = Path(__file__).parent.parent
+FILE_IDS_PATH = BASE_DIR / "data" / "telegram_file_ids.json"
+MAX_FILE_IDS = 50000
+# Через сколько секунд после изменения кэш file_id записывается на диск
+FILE_IDS_SAVE_DELAY = 5.0
+# sendMediaGroup принимает не больше 10 фотографий
+ALBUM_MAX_SIZE = 10
+ALBUM_FLUSH_SECONDS = getattr(config, "ALBUM_FLUSH_SECONDS", 20.0)
+
+
+class FileIdCache:
+    """
+    Соответствие "хэш содержимого изображения -> file_id в Telegram".
+    Картинка, которую Telegram уже видел, отправляется по file_id без повторной загрузки.
+    """
+
+    def __init__(self, path: Path, max_entries: int, save_delay: float = FILE_IDS_SAVE_DELAY):
+        self.path = path
+        self.max_entries = max_entries
+        self.save_delay = save_delay
+        self._ids: "OrderedDict[str, str]" = OrderedDict()
+        self._loaded = False
+        self._dirty = False
+        self._lock: Optional[asyncio.Lock] = None
+        self._timer: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._ids.update(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def get(self, content_hash: str) -> Optional[str]:
+        if not self._loaded:
+            self._load()
+        file_id = self._ids.get(content_hash)
+        if file_id is None:
+            self.stats["misses"] += 1
+            return None
+        self._ids.move_to_end(content_hash)
+        self.stats["hits"] += 1
+        return file_id
+
+    def put(self, content_hash: str, file_id: str):
+        if not self._loaded:
+            self._load()
+        self._ids[content_hash] = file_id
+        self._ids.move_to_end(content_hash)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+        self._mark_dirty()
+
+    def discard(self, content_hash: str):
+        if self._ids.pop(content_hash, None) is not None:
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        # Изменения подряд сливаются в одну запись через save_delay секунд,
+        # поэтому падение бота теряет не больше нескольких последних file_id
+        self._dirty = True
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.save_delay)
+        self._timer = None
+        await self.save()
+
+    def _write(self, payload: str):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        """Сохраняет кэш на диск, если он менялся. Записи идут по одной, под блокировкой."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._dirty:
+                return
+            payload = json.dumps(self._ids)
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._write, payload)
+            except OSError as e:
+                self._dirty = True
+                print(f"Ошибка записи кэша file_id: {e}")
+
+    async def close(self):
+        """Отменяет отложенную запись и дописывает изменения (при остановке бота)."""
+        if self._timer is not None:
+            # Таймер еще спит: уже начатая запись держит блокировку, и save ее дождется
+            self._timer.cancel()
+            self._timer = None
+        await self.save()
+
+
+file_id_cache = FileIdCache(FILE_IDS_PATH, MAX_FILE_IDS)
+metrics.register_cache("telegram_file_id", lambda: (file_id_cache.stats["hits"], file_id_cache.stats["misses"]))
+
+UPLOADED_BYTES = metrics.Counter("telegram_upload_bytes_total", "Байты изображений, загруженные в Telegram.", ["kind"])
+
+
+async def send_photo(message: types.Message, result: GenerationResult, filename: str,
+                     caption: Optional[str] = None,
+                     reply_markup: Optional[InlineKeyboardMarkup] = None) -> types.Message:
+    """
+    Отправляет изображение в чат сообщения. Если такая картинка уже уходила в Telegram,
+    она отправляется по file_id, иначе загружается и ее file_id запоминается.
+    """
+    file_id = file_id_cache.get(result.content_hash)
+    if file_id:
+        try:
+            return await message.answer_photo(file_id, caption=caption, reply_markup=reply_markup)
+        except TelegramBadRequest:
+            # file_id устарел или недоступен этому боту - загружаем заново
+            file_id_cache.discard(result.content_hash)
+
+    sent = await message.answer_photo(
+        await _photo_upload(result, filename),
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    if sent.photo:
+        file_id_cache.put(result.content_hash, sent.photo[-1].file_id)
+    return sent
+
+
+def _document_key(result: GenerationResult) -> str:
+    # У документа свой file_id, отличный от file_id фото с тем же содержимым
+    return f"doc:{result.content_hash}"
+
+
+def _original_file(result: GenerationResult, filename: str) -> InputFile:
+    # Файл, сохраненный A1111 на этой машине, загружается потоком с диска, без копии в памяти
+    UPLOADED_BYTES.inc("original", amount=result.size)
+    if result.path is not None:
+        return FSInputFile(result.path, filename=filename)
+    return BufferedInputFile(result.image, filename=filename)
+
+
+async def _photo_upload(result: GenerationResult, filename: str) -> InputFile:
+    """Перекодированное (если включено) изображение для загрузки фотографией."""
+    if not transcoding_enabled():
+        return _original_file(result, filename)
+    data, extension = await prepare_photo(result)
+    UPLOADED_BYTES.inc("photo", amount=len(data))
+    return BufferedInputFile(data, filename=f"{Path(filename).stem}.{extension}")
+
+
+async def _document_upload(result: GenerationResult, filename: str) -> Tuple[InputFile, Optional[BufferedInputFile]]:
+    """Исходный PNG без потерь и превью к нему."""
+    thumbnail = await prepare_thumbnail(result)
+    if thumbnail:
+        UPLOADED_BYTES.inc("thumbnail", amount=len(thumbnail))
+    return (
+        _original_file(result, filename),
+        BufferedInputFile(thumbnail, filename="thumbnail.jpg") if thumbnail else None,
+    )
+
+
+async def send_document(message: types.Message, result: GenerationResult, filename: str,
+                        caption: Optional[str] = None,
+                        reply_markup: Optional[InlineKeyboardMarkup] = None) -> types.Message:
+    """Отправляет исходный PNG документом (без сжатия Telegram), с превью."""
+    file_id = file_id_cache.get(_document_key(result))
+    if file_id:
+        try:
+            return await message.answer_document(file_id, caption=caption, reply_markup=reply_markup)
+        except TelegramBadRequest:
+            file_id_cache.discard(_document_key(result))
+
+    document, thumbnail = await _document_upload(result, filename)
+    sent = await message.answer_document(document, thumbnail=thumbnail, caption=caption, reply_markup=reply_markup)
+    if sent.document:
+        file_id_cache.put(_document_key(result), sent.document.file_id)
+    return sent
+
+
+class AlbumBatcher:
+    """
+    Копит готовые изображения пакета и отправляет их альбомами (sendMediaGroup):
+    как только набралось max_size штук или с первого изображения прошло max_delay
+    секунд. За каждым альбомом идет одно управляющее сообщение с клавиатурой,
+    его текст и кнопки строит make_control(сколько доставлено, индекс последнего промта).
+    С as_documents=True альбом состоит из исходных PNG-документов.
+    """
+
+    def __init__(self, message: types.Message,
+                 make_control: Callable[[int, int], Tuple[str, Optional[InlineKeyboardMarkup]]],
+                 max_size: int = ALBUM_MAX_SIZE, max_delay: float = ALBUM_FLUSH_SECONDS,
+                 as_documents: bool = False):
+        self.message = message
+        self.make_control = make_control
+        self.as_documents = as_documents
+        self.max_size = max(1, min(max_size, ALBUM_MAX_SIZE))
+        self.max_delay = max_delay
+        self.delivered = 0
+        # (изображение, подпись, индекс промта)
+        self._items: List[Tuple[GenerationResult, str, int]] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    async def add(self, result: GenerationResult, caption: str, prompt_index: int):
+        self._items.append((result, caption, prompt_index))
+        if len(self._items) >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # Задачу таймера никто не ждет: ошибку только логируем, изображения остаются до следующей отправки
+            print(f"Ошибка при отправке альбома: {e}")
+
+    def _cache_key(self, result: GenerationResult) -> str:
+        return _document_key(result) if self.as_documents else result.content_hash
+
+    async def _build_item(self, result: GenerationResult, caption: str, prompt_index: int, use_file_ids: bool):
+        file_id = file_id_cache.get(self._cache_key(result)) if use_file_ids else None
+        filename = f"img_{prompt_index + 1}.png"
+        if self.as_documents:
+            if file_id:
+                return InputMediaDocument(media=file_id, caption=caption)
+            document, thumbnail = await _document_upload(result, filename)
+            return InputMediaDocument(media=document, thumbnail=thumbnail, caption=caption)
+        return InputMediaPhoto(media=file_id or await _photo_upload(result, filename), caption=caption)
+
+    async def _build_media(self, items: List[Tuple[GenerationResult, str, int]], use_file_ids: bool) -> list:
+        # Перекодирование всех изображений альбома идет параллельно в пуле процессов
+        return list(await asyncio.gather(*(
+            self._build_item(result, caption, prompt_index, use_file_ids)
+            for result, caption, prompt_index in items
+        )))
+
+    async def _send_album(self, items: List[Tuple[GenerationResult, str, int]]):
+        if len(items) == 1:
+            # Альбом из одного элемента Telegram не принимает
+            result, caption, prompt_index = items[0]
+            send = send_document if self.as_documents else send_photo
+            await send(self.message, result, filename=f"img_{prompt_index + 1}.png", caption=caption)
+            return
+
+        media = await self._build_media(items, use_file_ids=True)
+        try:
+            sent = await self.message.answer_media_group(media)
+        except TelegramBadRequest:
+            if all(isinstance(item.media, InputFile) for item in media):
+                raise
+            # Какой-то из file_id устарел - загружаем весь альбом заново
+            for result, _, _ in items:
+                file_id_cache.discard(self._cache_key(result))
+            sent = await self.message.answer_media_group(await self._build_media(items, use_file_ids=False))
+
+        for (result, _, _), sent_message in zip(items, sent):
+            if self.as_documents and sent_message.document:
+                file_id_cache.put(self._cache_key(result), sent_message.document.file_id)
+            elif sent_message.photo:
+                file_id_cache.put(self._cache_key(result), sent_message.photo[-1].file_id)
+
+    async def flush(self):
+        """Отправляет накопленные изображения альбомом и управляющее сообщение после него."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            items, self._items = self._items, []
+            if not items:
+                return
+            try:
+                await self._send_album(items)
+            except Exception:
+                # Не теряем изображения: их отправит следующий flush
+                self._items[:0] = items
+                raise
+            self.delivered += len(items)
+            text, reply_markup = self.make_control(self.delivered, items[-1][2])
+            await self.message.answer(text, reply_markup=reply_markup)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
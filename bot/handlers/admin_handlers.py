@@ -1,5 +1,4 @@
 # bot/handlers/admin_handlers.py
-import json
 from typing import Union
 from aiogram import Router, F, types
 from aiogram.filters import Command
@@ -12,8 +11,9 @@ from bot.keyboards import (
     get_alias_management_keyboard
 )
 from services.prompt_logic import load_character_data, save_character_data
-from services.a1111_api_service import get_available_models
-from bot.middleware import load_settings
+from services.catalog_service import catalog
+from services.settings_service import load_settings, save_settings
+from bot.middleware import membership_cache
 
 router = Router()
 # Фильтр на админов
@@ -110,7 +110,8 @@ async def enter_environments(message: types.Message, state: FSMContext):
 async def process_optional_category_name(message: types.Message, state: FSMContext):
     if message.text.lower().strip() == 'готово':
         data = await state.get_data()
-        all_chars = load_character_data()
+        # Кэш базы общий, поэтому меняем копию
+        all_chars = dict(load_character_data())
         
         new_char_data = {
             "name": data.get("name"),
@@ -164,8 +165,7 @@ async def set_bot_status(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Этот режим уже активен.")
         return
     settings["bot_status"] = new_status
-    with open("data/settings.json", "w") as f:
-        json.dump(settings, f, indent=2)
+    save_settings()
     await callback.message.edit_text(
         f"Статус бота изменен. Текущий режим: `{new_status}`",
         parse_mode="Markdown",
@@ -178,8 +178,7 @@ async def set_bot_status(callback: types.CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "admin_manage_aliases")
 async def manage_aliases_menu(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.edit_text("Загружаю список моделей из A1111...")
-    models = get_available_models()
+    models = await catalog.get_models()
     if not models:
         await callback.message.edit_text("Не удалось получить список моделей. Убедитесь, что A1111 запущен и доступен.")
         await callback.answer()
@@ -192,6 +191,25 @@ async def manage_aliases_menu(callback: types.CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
+@router.callback_query(F.data == "admin_refresh_catalog")
+async def refresh_catalog(callback: types.CallbackQuery, state: FSMContext):
+    await callback.message.edit_text("Обновляю каталог A1111 (пересканирование моделей и LoRA)...")
+    if not await catalog.refresh(rescan=True):
+        await callback.message.edit_text(
+            "Не удалось обновить каталог. Убедитесь, что A1111 запущен и доступен.",
+            reply_markup=get_alias_management_keyboard(catalog.models, load_settings().get("model_aliases", {}))
+        )
+        await callback.answer()
+        return
+    counts = catalog.summary()
+    await callback.message.edit_text(
+        f"✅ Каталог обновлен: моделей {counts['models']}, семплеров {counts['samplers']}, "
+        f"LoRA {counts['loras']}, эмбеддингов {counts['embeddings']}.\n\n"
+        "Нажмите на модель, чтобы задать или изменить для нее псевдоним:",
+        reply_markup=get_alias_management_keyboard(catalog.models, load_settings().get("model_aliases", {}))
+    )
+    await callback.answer()
+
 @router.callback_query(F.data.startswith("alias_model_"))
 async def alias_model_start(callback: types.CallbackQuery, state: FSMContext):
     model_file = callback.data.removeprefix("alias_model_")
@@ -218,8 +236,7 @@ async def alias_model_finish(message: types.Message, state: FSMContext):
         aliases[model_file] = alias
         await message.answer(f"✅ Установлен псевдоним: `{model_file}` -> **{alias}**", parse_mode="Markdown")
     settings["model_aliases"] = aliases
-    with open("data/settings.json", "w") as f:
-        json.dump(settings, f, indent=2, ensure_ascii=False)
+    save_settings()
     await state.clear()
     callback_for_menu = types.CallbackQuery(id="return_to_aliases", from_user=message.from_user, chat_instance="fake", message=message, data="admin_manage_aliases")
     await manage_aliases_menu(callback_for_menu, state)
@@ -270,8 +287,7 @@ async def process_new_limit(message: types.Message, state: FSMContext, limit_key
     settings = load_settings()
     settings[limit_key] = new_limit
     
-    with open("data/settings.json", "w") as f:
-        json.dump(settings, f, indent=2)
+    save_settings()
         
     await message.answer(f"✅ Лимит `{limit_key}` обновлен на значение: {new_limit}")
     await state.clear()
@@ -309,8 +325,9 @@ async def set_channel_finish(message: types.Message, state: FSMContext):
             return
         settings["required_channel_id"] = message.text if message.text.startswith('@') else int(message.text)
         await message.answer(f"✅ Установлен обязательный канал: {message.text}")
-    with open("data/settings.json", "w") as f:
-        json.dump(settings, f, indent=2)
+    save_settings()
+    # Результаты проверок подписки относились к старому каналу
+    membership_cache.clear()
     await state.clear()
     await message.answer("Панель администратора:", reply_markup=get_admin_keyboard())
 
@@ -370,8 +387,7 @@ async def whitelist_add_get_name(message: types.Message, state: FSMContext):
     username = user_data["new_whitelist_username"]
     settings = load_settings()
     settings["whitelist"][str(user_id)] = {"username": username, "custom_name": custom_name}
-    with open("data/settings.json", "w") as f:
-        json.dump(settings, f, indent=2, ensure_ascii=False)
+    save_settings()
     await message.answer(f"✅ Пользователь **{custom_name}** (@{username}) успешно добавлен в белый список!", parse_mode="Markdown")
     await state.clear()
     await show_whitelist_menu(message)
@@ -392,8 +408,7 @@ async def whitelist_remove_finish(message: types.Message, state: FSMContext):
     if user_id_to_remove in settings["whitelist"]:
         removed_user_name = settings["whitelist"][user_id_to_remove]["custom_name"]
         del settings["whitelist"][user_id_to_remove]
-        with open("data/settings.json", "w") as f:
-            json.dump(settings, f, indent=2)
+        save_settings()
         await message.answer(f"✅ Пользователь **{removed_user_name}** (`{user_id_to_remove}`) удален из Whitelist.", parse_mode="Markdown")
     else:
         await message.answer(f"⚠️ Пользователя с ID `{user_id_to_remove}` нет в Whitelist.")
@@ -1,13 +1,16 @@
 # bot/handlers/user_handlers.py
 import asyncio
-from typing import Union
+from collections import deque
+from typing import Optional, Union
 from aiogram import Router, F, types
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
-from aiogram.types import BufferedInputFile
 
 import config
 from bot.states import GenerateFlow
+from bot.delivery import AlbumBatcher, send_document, send_photo
+from bot.progress import ProgressMessage
+from bot.throttling import outbound_priority, PRIORITY_BULK
 # --- КЛАВИАТУРЫ: СТАРАЯ get_character_keyboard УДАЛЕНА ---
 from bot.keyboards import (
     get_generation_keyboard, get_settings_keyboard, get_sampler_keyboard,
@@ -15,16 +18,51 @@ from bot.keyboards import (
     get_saved_prompts_keyboard, get_delete_prompts_keyboard, get_character_selection_keyboard
 )
 # --- ЛОГИКА: ИСПОЛЬЗУЕТСЯ НОВАЯ ФУНКЦИЯ ДЛЯ НЕСКОЛЬКИХ ПЕРСОНАЖЕЙ ---
-from services.prompt_logic import generate_prompts_for_characters
-from services.a1111_api_service import generate_image, get_available_models
+from services.prompt_logic import (
+    PromptCombinations, make_prompt_recipe, resolve_prompt_recipe
+)
+from services.catalog_service import catalog
+from services.generation_scheduler import (
+    scheduler, PRIORITY_ADMIN, PRIORITY_WHITELIST, PRIORITY_DEFAULT
+)
 from services.user_data_service import (
     get_user_data, save_user_data, add_saved_prompt, remove_saved_prompt, MAX_SAVED_PROMPTS
 )
-from bot.middleware import load_settings
+from services.settings_service import load_settings
 
 router = Router()
 
-def format_prompt_message(prompts: list, index: int) -> str:
+# Сколько задач одного пакета одновременно держать в очереди планировщика
+BATCH_SUBMIT_WINDOW = getattr(config, "BATCH_SUBMIT_WINDOW", 10)
+
+# Ссылки на фоновые задачи доставки, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def get_user_priority(user_id: int) -> int:
+    """Приоритетная полоса в очереди генерации: админы, затем whitelist, затем остальные."""
+    if user_id in config.ADMIN_IDS:
+        return PRIORITY_ADMIN
+    if str(user_id) in load_settings().get("whitelist", {}):
+        return PRIORITY_WHITELIST
+    return PRIORITY_DEFAULT
+
+def format_queue_position(user_id: int) -> str:
+    position = scheduler.get_queue_position(user_id)
+    return f" Позиция в очереди: {position}." if position and position > 1 else ""
+
+PROMPTS_NOT_FOUND_TEXT = "Данные о промтах не найдены или устарели, начните заново: /generate"
+
+def get_state_prompts(user_data: dict) -> Optional[PromptCombinations]:
+    """Восстанавливает набор промтов по рецепту из FSM (сам список в FSM не хранится)."""
+    return resolve_prompt_recipe(user_data.get("prompt_recipe"))
+
+def format_prompt_message(prompts: PromptCombinations, index: int) -> str:
     positive, negative = prompts[index]
     return (
         f"**Вариант {index + 1}/{len(prompts)}**\n\n"
@@ -114,8 +152,8 @@ async def edit_setting(callback: types.CallbackQuery, state: FSMContext):
     setting_key = callback.data.removeprefix("edit_setting_")
 
     if setting_key == "model_name":
-        await callback.message.edit_text("Загружаю список моделей из A1111...")
-        models = get_available_models()
+        # Список берется из кэша каталога: диск A1111 здесь не пересканируется
+        models = await catalog.get_models()
         if not models:
             await callback.answer("Не удалось получить список моделей. Проверьте, что A1111 запущен.", show_alert=True)
             user_data = await state.get_data()
@@ -135,7 +173,7 @@ async def edit_setting(callback: types.CallbackQuery, state: FSMContext):
     if setting_key == "sampler_name":
         await callback.message.edit_text(
             "Выберите семплер из списка:",
-            reply_markup=get_sampler_keyboard()
+            reply_markup=get_sampler_keyboard(await catalog.get_samplers())
         )
         await callback.answer()
         return
@@ -152,6 +190,14 @@ async def edit_setting(callback: types.CallbackQuery, state: FSMContext):
             "• *Высокое (11+):* строгое следование промту."
         )
         message_text += tooltip
+    elif setting_key == 'seed':
+        message_text += (
+            "\n\n*Подсказка по Seed:*\n"
+            "• *-1:* случайный seed для каждого нового изображения. Если снова запросить "
+            "уже полученный промт с теми же настройками, придет та же картинка из кэша.\n"
+            "• *Любое число от 0:* фиксированный seed - результат можно повторить, "
+            "а повторный запрос того же промта отдается мгновенно из кэша."
+        )
         
     await callback.message.edit_text(message_text, parse_mode="Markdown")
     await callback.answer()
@@ -193,6 +239,23 @@ async def select_sampler(callback: types.CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
+@router.callback_query(GenerateFlow.settings_menu, F.data == "toggle_setting_send_original")
+async def toggle_send_original(callback: types.CallbackQuery, state: FSMContext):
+    user_data_state = await state.get_data()
+    settings = user_data_state.get("settings")
+    settings["send_original"] = not settings.get("send_original", False)
+
+    user_data_db = get_user_data(callback.from_user.id)
+    user_data_db["settings"] = settings
+    save_user_data(callback.from_user.id, user_data_db)
+
+    await state.update_data(settings=settings)
+    await callback.message.edit_reply_markup(reply_markup=get_settings_keyboard(settings))
+    await callback.answer(
+        "Изображения будут приходить исходными PNG-файлами." if settings["send_original"]
+        else "Изображения будут приходить сжатыми фотографиями."
+    )
+
 @router.callback_query(GenerateFlow.settings_menu, F.data == "back_to_settings")
 async def back_to_settings(callback: types.CallbackQuery, state: FSMContext):
     user_data = await state.get_data()
@@ -209,7 +272,7 @@ async def enter_setting_value(message: types.Message, state: FSMContext):
     setting_key = user_data_state.get("editing_setting")
     new_value = message.text
     try:
-        if setting_key in ["steps", "width", "height"]:
+        if setting_key in ["steps", "width", "height", "seed"]:
             new_value = int(new_value)
         elif setting_key == "cfg_scale":
             new_value = float(new_value)
@@ -236,8 +299,9 @@ async def generate_and_show_prompts(message_or_callback: Union[types.Message, ty
     user_data = await state.get_data()
     # Получаем СПИСОК персонажей
     character_ids = user_data["selected_characters"]
-    # Вызываем НОВУЮ функцию
-    prompts = generate_prompts_for_characters(character_ids, base_prompt)
+    # Набор комбинаций строится лениво и кэшируется по рецепту
+    recipe = make_prompt_recipe(character_ids, base_prompt)
+    prompts = resolve_prompt_recipe(recipe)
     
     if not prompts:
         await message_or_callback.answer("Не удалось сгенерировать промты.")
@@ -261,7 +325,8 @@ async def generate_and_show_prompts(message_or_callback: Union[types.Message, ty
             await message_or_callback.answer(text)
         return
         
-    await state.update_data(prompts=prompts, current_index=0)
+    # В FSM кладем только рецепт, комбинации пересобираются по нему на лету
+    await state.update_data(prompt_recipe=recipe, current_index=0)
     await state.set_state(GenerateFlow.viewing_results)
     
     target_message = message_or_callback.message if isinstance(message_or_callback, types.CallbackQuery) else message_or_callback
@@ -337,7 +402,10 @@ async def navigate_prompts(callback: types.CallbackQuery, state: FSMContext):
     new_index = int(callback.data.split("_")[1])
     await state.update_data(current_index=new_index)
     user_data = await state.get_data()
-    prompts = user_data["prompts"]
+    prompts = get_state_prompts(user_data)
+    if not prompts or new_index >= len(prompts):
+        await callback.answer(PROMPTS_NOT_FOUND_TEXT, show_alert=True)
+        return
     await callback.message.edit_text(
         format_prompt_message(prompts, new_index),
         parse_mode="Markdown",
@@ -348,28 +416,86 @@ async def navigate_prompts(callback: types.CallbackQuery, state: FSMContext):
 
 # --- ЛОГИКА ГЕНЕРАЦИИ ИЗОБРАЖЕНИЙ ---
 
-async def run_generation_task(message: types.Message, state: FSMContext, prompts_to_generate: list, start_index: int):
+async def run_generation_task(message: types.Message, state: FSMContext, start_index: int, count: int, user_id: int):
+    # Задача фоновая (свой контекст): ее сообщения уступают место интерактивным ответам
+    outbound_priority.set(PRIORITY_BULK)
     user_data = await state.get_data()
     settings = user_data["settings"]
-    total_prompts = len(user_data["prompts"])
-    
-    for i, (positive, negative) in enumerate(prompts_to_generate, start=1):
-        current_prompt_index = start_index + i - 1
-        await state.update_data(current_index=current_prompt_index)
-        
-        await message.answer(f"⏳ Генерирую изображение {i}/{len(prompts_to_generate)} (промт №{current_prompt_index + 1})...")
-        image_bytes = generate_image(positive, negative, settings)
-        
-        if image_bytes:
-            photo = BufferedInputFile(image_bytes, filename=f"img_{i}.png")
-            await message.answer_photo(
-                photo, 
-                caption=f"✅ Изображение {i}/{len(prompts_to_generate)} готово!",
-                reply_markup=get_post_generation_keyboard(current_prompt_index, total_prompts)
-            )
-        else:
-            await message.answer(f"❌ Ошибка при генерации изображения {i}/{len(prompts_to_generate)}.")
-        await asyncio.sleep(1)
+    prompts = get_state_prompts(user_data)
+    if not prompts:
+        await message.answer(PROMPTS_NOT_FOUND_TEXT)
+        return
+    total_prompts = len(prompts)
+    priority = get_user_priority(user_id)
+    indices = iter(range(start_index, min(start_index + count, total_prompts)))
+    amount = min(count, total_prompts - start_index)
+
+    # Прогресс показываем одним статусным сообщением на весь пакет, только для ожидаемого сейчас изображения
+    progress = ProgressMessage(f"⏳ Генерирую изображения: 0/{amount}...")
+    current = {"index": None}
+    failed = []
+    # Сколько неудачных промтов уже показано в управляющих сообщениях
+    reported = {"failed": 0}
+
+    def make_control(delivered: int, last_prompt_index: int):
+        reported["failed"] = len(failed)
+        text = f"✅ Готово {delivered}/{amount} (последний промт №{last_prompt_index + 1})."
+        if failed:
+            text += f"\n❌ Не удалось сгенерировать промты: {', '.join(str(index + 1) for index in failed)}."
+        return text, get_post_generation_keyboard(last_prompt_index, total_prompts)
+
+    batcher = AlbumBatcher(message, make_control, as_documents=settings.get("send_original", False))
+
+    # В очереди планировщика держим лишь окно из нескольких задач пакета:
+    # промты собираются по мере продвижения, а не все сразу
+    pending = deque()
+
+    def refill():
+        while len(pending) < BATCH_SUBMIT_WINDOW:
+            prompt_index = next(indices, None)
+            if prompt_index is None:
+                return
+            positive, negative = prompts[prompt_index]
+
+            def on_progress(value: float, eta: float, prompt_index=prompt_index):
+                if current["index"] == prompt_index:
+                    progress(value, eta)
+
+            future = scheduler.submit(user_id, positive, negative, settings, priority, on_progress=on_progress)
+            pending.append((prompt_index, future))
+
+    refill()
+    try:
+        progress.attach(await message.answer(f"{progress.text}{format_queue_position(user_id)}"))
+        i = 0
+        while pending:
+            current_prompt_index, future = pending.popleft()
+            refill()
+            i += 1
+            current["index"] = current_prompt_index
+            progress.text = f"⏳ Генерирую изображение {i}/{amount} (промт №{current_prompt_index + 1})..."
+            await state.update_data(current_index=current_prompt_index)
+
+            result = await future
+            if result:
+                await batcher.add(result, f"№{current_prompt_index + 1} · 🌱 Seed: {result.seed}", current_prompt_index)
+            else:
+                failed.append(current_prompt_index)
+
+        progress.close()
+        await batcher.flush()
+        if failed and not batcher.delivered:
+            await message.answer(f"❌ Не удалось сгенерировать ни одного изображения из {amount}. Проверьте, запущен ли A1111.")
+        elif len(failed) > reported["failed"]:
+            # Последние промты не удались уже после отправки альбома: итог и клавиатура по последнему промту
+            text, reply_markup = make_control(batcher.delivered, current["index"])
+            await message.answer(text, reply_markup=reply_markup)
+    finally:
+        progress.close()
+        batcher.cancel()
+        # Если доставка прервана, незапущенные задачи не должны занимать GPU
+        for _, future in pending:
+            future.cancel()
 
 @router.callback_query(GenerateFlow.viewing_results, F.data.startswith("generate_img_"))
 async def generate_single_image(callback: types.CallbackQuery, state: FSMContext, bot_status: str):
@@ -377,29 +503,45 @@ async def generate_single_image(callback: types.CallbackQuery, state: FSMContext
         await callback.answer("Генерация изображений временно отключена.", show_alert=True)
         return
 
-    await callback.message.edit_text("⏳ Ваше изображение генерируется...", reply_markup=None)
-    
     user_data = await state.get_data()
-    prompts = user_data["prompts"]
+    prompts = get_state_prompts(user_data)
     settings = user_data["settings"]
     index = int(callback.data.split("_")[2])
+    if not prompts or index >= len(prompts):
+        await callback.answer(PROMPTS_NOT_FOUND_TEXT, show_alert=True)
+        return
     await state.update_data(current_index=index)
     positive_prompt, negative_prompt = prompts[index]
 
-    image_bytes = generate_image(positive_prompt, negative_prompt, settings)
-    await callback.message.delete()
+    user_id = callback.from_user.id
+    progress = ProgressMessage("⏳ Ваше изображение генерируется...")
+    future = scheduler.submit(user_id, positive_prompt, negative_prompt, settings, get_user_priority(user_id),
+                              on_progress=progress)
+    await callback.message.edit_text(f"{progress.text}{format_queue_position(user_id)}", reply_markup=None)
+    progress.attach(callback.message)
+    await callback.answer()
+    # Ждем изображение вне обработчика: апдейт не должен держать слот все время генерации
+    start_background_task(deliver_single_image(callback.message, future, progress, settings, index, len(prompts)))
 
-    if image_bytes:
-        photo = BufferedInputFile(image_bytes, filename="generated_image.png")
-        await callback.message.answer_photo(
-            photo, 
-            caption=f"✅ Изображение по промту №{index + 1} готово!",
-            reply_markup=get_post_generation_keyboard(index, len(prompts))
+async def deliver_single_image(message: types.Message, future: asyncio.Future, progress: ProgressMessage,
+                               settings: dict, index: int, total_prompts: int):
+    try:
+        result = await future
+    finally:
+        progress.close()
+        # Если доставку прервали, задача не должна занимать GPU
+        future.cancel()
+    await message.delete()
+
+    if result:
+        send = send_document if settings.get("send_original", False) else send_photo
+        await send(
+            message, result, filename="generated_image.png",
+            caption=f"✅ Изображение по промту №{index + 1} готово!\n🌱 Seed: {result.seed}",
+            reply_markup=get_post_generation_keyboard(index, total_prompts)
         )
     else:
-        await callback.message.answer("❌ Не удалось сгенерировать изображение. Проверьте, запущен ли A1111.")
-    
-    await callback.answer()
+        await message.answer("❌ Не удалось сгенерировать изображение. Проверьте, запущен ли A1111.")
 
 @router.callback_query(GenerateFlow.viewing_results, F.data == "generate_all")
 async def generate_all_images(callback: types.CallbackQuery, state: FSMContext, bot_status: str):
@@ -407,11 +549,14 @@ async def generate_all_images(callback: types.CallbackQuery, state: FSMContext,
         await callback.answer("Генерация изображений временно отключена.", show_alert=True)
         return
         
-    await callback.message.delete()
     user_data = await state.get_data()
-    prompts = user_data["prompts"]
+    prompts = get_state_prompts(user_data)
+    if not prompts:
+        await callback.answer(PROMPTS_NOT_FOUND_TEXT, show_alert=True)
+        return
+    await callback.message.delete()
     await callback.message.answer(f"✅ Принято! Начинаю генерацию всех {len(prompts)} изображений.")
-    asyncio.create_task(run_generation_task(callback.message, state, prompts, start_index=0))
+    start_background_task(run_generation_task(callback.message, state, start_index=0, count=len(prompts), user_id=callback.from_user.id))
     await callback.answer()
 
 @router.callback_query(GenerateFlow.viewing_results, F.data == "generate_batch_start")
@@ -437,14 +582,14 @@ async def post_gen_main_menu(callback: types.CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "post_gen_show_prompts")
 async def post_gen_show_prompts(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.delete()
     user_data = await state.get_data()
-    prompts = user_data.get("prompts", [])
+    prompts = get_state_prompts(user_data)
     index = user_data.get("current_index", 0)
     
-    if not prompts:
-        await callback.answer("Данные о промтах не найдены, начните заново.", show_alert=True)
+    if not prompts or index >= len(prompts):
+        await callback.answer(PROMPTS_NOT_FOUND_TEXT, show_alert=True)
         return
+    await callback.message.delete()
         
     await callback.message.answer(
         format_prompt_message(prompts, index),
@@ -460,17 +605,20 @@ async def post_gen_all_remaining(callback: types.CallbackQuery, state: FSMContex
         return
         
     user_data = await state.get_data()
-    prompts = user_data.get("prompts", [])
+    prompts = get_state_prompts(user_data)
+    if not prompts:
+        await callback.answer(PROMPTS_NOT_FOUND_TEXT, show_alert=True)
+        return
     current_index = user_data.get("current_index", 0)
     
-    remaining_prompts = prompts[current_index + 1:]
-    if not remaining_prompts:
+    remaining_count = len(prompts) - (current_index + 1)
+    if remaining_count <= 0:
         await callback.answer("Больше нет промтов для генерации.", show_alert=True)
         return
         
     await callback.message.delete_reply_markup()
-    await callback.message.answer(f"✅ Принято! Начинаю генерацию оставшихся {len(remaining_prompts)} изображений.")
-    asyncio.create_task(run_generation_task(callback.message, state, remaining_prompts, start_index=current_index + 1))
+    await callback.message.answer(f"✅ Принято! Начинаю генерацию оставшихся {remaining_count} изображений.")
+    start_background_task(run_generation_task(callback.message, state, start_index=current_index + 1, count=remaining_count, user_id=callback.from_user.id))
     await callback.answer()
 
 @router.callback_query(F.data == "post_gen_batch_start")
@@ -491,18 +639,22 @@ async def generate_batch_finish(message: types.Message, state: FSMContext):
     
     amount = int(message.text)
     user_data = await state.get_data()
-    prompts = user_data.get("prompts", [])
+    prompts = get_state_prompts(user_data)
+    if not prompts:
+        await message.answer(PROMPTS_NOT_FOUND_TEXT)
+        await state.set_state(GenerateFlow.viewing_results)
+        return
     current_index = user_data.get("current_index", 0)
     
-    prompts_to_generate = prompts[current_index + 1 : current_index + 1 + amount]
+    amount = min(amount, len(prompts) - (current_index + 1))
     
-    if not prompts_to_generate:
+    if amount <= 0:
         await message.answer("Больше нет промтов для генерации.")
         await state.set_state(GenerateFlow.viewing_results)
         return
 
-    await message.answer(f"✅ Принято! Начинаю генерацию следующих {len(prompts_to_generate)} изображений.")
-    asyncio.create_task(run_generation_task(message, state, prompts_to_generate, start_index=current_index + 1))
+    await message.answer(f"✅ Принято! Начинаю генерацию следующих {amount} изображений.")
+    start_background_task(run_generation_task(message, state, start_index=current_index + 1, count=amount, user_id=message.from_user.id))
     await state.set_state(GenerateFlow.viewing_results)
 
 @router.callback_query(F.data == "ignore")
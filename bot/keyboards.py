@@ -3,10 +3,10 @@ from aiogram import types
 from aiogram.types import InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from services.prompt_logic import load_character_data
-from bot.middleware import load_settings
+from services.settings_service import load_settings
 from services.user_data_service import get_user_data
 
-# Константа со списком семплеров для удобства
+# Запасной список семплеров, пока каталог A1111 еще не загружен
 SAMPLERS = [
     "DPM++ 2M", "DPM++ SDE", "DPM++ 2M SDE", "DPM++ 2M SDE Heun", 
     "DPM++ 2S a", "DPM++ 3M SDE", "Euler a", "Euler", "LMS", 
@@ -116,10 +116,14 @@ def get_settings_keyboard(settings: dict) -> InlineKeyboardMarkup:
     builder.button(text=f"CFG Scale: {settings['cfg_scale']}", callback_data="edit_setting_cfg_scale")
     builder.button(text=f"Ширина: {settings['width']}", callback_data="edit_setting_width")
     builder.button(text=f"Высота: {settings['height']}", callback_data="edit_setting_height")
+    seed = settings.get("seed", -1)
+    builder.button(text=f"Seed: {'🎲 случайный' if seed < 0 else seed}", callback_data="edit_setting_seed")
+    send_original = settings.get("send_original", False)
+    builder.button(text=f"Оригинал PNG: {'✅' if send_original else '❌'}", callback_data="toggle_setting_send_original")
     
     builder.button(text="✅ Готово, ввести промт", callback_data="settings_done")
     
-    builder.adjust(1, 2, 2, 2, 1)
+    builder.adjust(1, 2, 2, 2, 1, 1)
     return builder.as_markup()
 
 def get_model_selection_keyboard(models: list, aliases: dict) -> InlineKeyboardMarkup:
@@ -147,9 +151,9 @@ def get_generation_keyboard(prompt_index: int, total_prompts: int) -> InlineKeyb
     builder.adjust(3, 1, 2)
     return builder.as_markup()
 
-def get_sampler_keyboard() -> InlineKeyboardMarkup:
+def get_sampler_keyboard(samplers: list = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    for sampler in SAMPLERS:
+    for sampler in samplers or SAMPLERS:
         builder.button(
             text=sampler,
             callback_data=f"set_sampler_{sampler}"
@@ -228,5 +232,6 @@ def get_alias_management_keyboard(models: list, aliases: dict) -> InlineKeyboard
             callback_data=f"alias_model_{model_file}"
         )
     builder.adjust(1)
+    builder.row(types.InlineKeyboardButton(text="🔄 Обновить список из A1111", callback_data="admin_refresh_catalog"))
     builder.row(types.InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back_to_main_menu"))
     return builder.as_markup()
\ No newline at end of file
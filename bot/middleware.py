@@ -1,24 +1,80 @@
 # bot/middleware.py
-import json
-from typing import Callable, Dict, Any, Awaitable
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Awaitable, Tuple, Union
 from aiogram import BaseMiddleware, Bot, types
 from aiogram.types import TelegramObject, User
 from aiogram.exceptions import TelegramBadRequest
 
 import config
+from services import metrics
+from services.settings_service import load_settings
 
-SETTINGS_FILE = "data/settings.json"
+UPDATES = metrics.Counter("bot_updates_total", "Апдейты от Telegram по типам.", ["type"])
+HANDLER_LATENCY = metrics.Histogram("bot_handler_seconds", "Время работы обработчиков.", ["router", "handler"])
+ACCESS_REJECTIONS = metrics.Counter("bot_access_rejections_total", "Апдейты, отклоненные AccessMiddleware.", ["reason"])
+
+class MembershipCache:
+    """
+    Кэш результатов проверки подписки на обязательный канал.
+    Положительный и отрицательный ответы живут разное время (подписавшийся
+    пользователь не должен долго ждать), размер кэша ограничен, а одновременные
+    проверки одного пользователя склеиваются в один запрос get_chat_member.
+    """
+
+    def __init__(self, positive_ttl: float = 600, negative_ttl: float = 30, max_size: int = 50000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # (канал, пользователь) -> (подписан ли, момент устаревания)
+        self._entries: "OrderedDict[Tuple[Union[int, str], int], Tuple[bool, float]]" = OrderedDict()
+        self._pending: Dict[Tuple[Union[int, str], int], asyncio.Task] = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def is_member(self, bot: Bot, channel_id: Union[int, str], user_id: int) -> bool:
+        key = (channel_id, user_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[0]
+
+        self.stats["misses"] += 1
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bot, channel_id, user_id))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot: Bot, channel_id: Union[int, str], user_id: int) -> bool:
+        try:
+            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+            is_member = member.status.value in ["creator", "administrator", "member"]
+        except TelegramBadRequest:
+            is_member = False
+
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        key = (channel_id, user_id)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return is_member
+
+    def clear(self):
+        """Сбрасывает кэш (например, после смены обязательного канала)."""
+        self._entries.clear()
+
+
+membership_cache = MembershipCache(
+    positive_ttl=getattr(config, "MEMBERSHIP_CACHE_POSITIVE_TTL", 600),
+    negative_ttl=getattr(config, "MEMBERSHIP_CACHE_NEGATIVE_TTL", 30),
+    max_size=getattr(config, "MEMBERSHIP_CACHE_SIZE", 50000),
+)
+metrics.register_cache("membership", lambda: (membership_cache.stats["hits"], membership_cache.stats["misses"]))
 
-def load_settings() -> dict:
-    """Загружает настройки из JSON-файла."""
-    try:
-        with open(SETTINGS_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        default_settings = {"required_channel_id": None, "whitelist": {}, "bot_status": "active"}
-        with open(SETTINGS_FILE, "w") as f:
-            json.dump(default_settings, f, indent=2)
-        return default_settings
 
 class AccessMiddleware(BaseMiddleware):
     async def __call__(
@@ -40,11 +96,13 @@ class AccessMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         if bot_status == "full_stop":
+            ACCESS_REJECTIONS.inc("full_stop")
             if hasattr(event, "answer"):
                 await event.answer("Бот временно отключен.", show_alert=True)
             return
         
         if bot_status == "whitelist_only" and str(user.id) not in settings.get("whitelist", {}):
+            ACCESS_REJECTIONS.inc("whitelist_only")
             if hasattr(event, "answer"):
                 await event.answer("В данный момент бот доступен только для ограниченного круга пользователей.", show_alert=True)
             return
@@ -52,12 +110,8 @@ class AccessMiddleware(BaseMiddleware):
         channel_id = settings.get("required_channel_id")
         if channel_id and str(user.id) not in settings.get("whitelist", {}):
             bot: Bot = data.get("bot")
-            try:
-                member = await bot.get_chat_member(chat_id=channel_id, user_id=user.id)
-                # Исправлена проверка статуса
-                if member.status.value not in ["creator", "administrator", "member"]:
-                    raise TelegramBadRequest(message="User is not a member")
-            except TelegramBadRequest:
+            if not await membership_cache.is_member(bot, channel_id, user.id):
+                ACCESS_REJECTIONS.inc("not_subscribed")
                 channel_link = f"https://t.me/{str(channel_id).replace('@', '')}" if '@' in str(channel_id) else "канал"
                 text = f"Для использования бота, пожалуйста, подпишитесь на наш {channel_link} и повторите команду."
                 
@@ -67,4 +121,63 @@ class AccessMiddleware(BaseMiddleware):
                     await event.answer(text, show_alert=True)
                 return
         
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает число одновременно обрабатываемых апдейтов. И polling, и вебхук
+    в фоновом режиме запускают каждый апдейт отдельной задачей, и без предела
+    всплеск нагрузки превращается в тысячи параллельных обращений к базе и Telegram.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Считает входящие апдейты по типам (апдейты в секунду - rate() в Prometheus)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        UPDATES.inc(getattr(event, "event_type", "unknown"))
+        return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Время работы обработчиков роутера. Вешается внутренним middleware на
+    сообщения и колбэки роутера, поэтому срабатывает уже после выбора обработчика.
+    Метка handler - имя функции: она однозначно соответствует префиксу колбэка,
+    а хвост callback_data (id персонажа, имя модели) в метки не попадает.
+    """
+
+    def __init__(self, router_name: str):
+        self.router_name = router_name
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+            HANDLER_LATENCY.observe(time.perf_counter() - started, self.router_name, name)
@@ -0,0 +1,86 @@
+# bot/progress.py
+import asyncio
+import time
+from typing import Optional, Tuple
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import config
+from bot.throttling import outbound_priority, PRIORITY_BULK
+
+# Не чаще одного редактирования статусного сообщения за столько секунд
+PROGRESS_EDIT_INTERVAL = getattr(config, "PROGRESS_EDIT_INTERVAL", 3.0)
+PROGRESS_BAR_WIDTH = 10
+
+
+def format_progress(progress: float, eta: float) -> str:
+    filled = int(round(progress * PROGRESS_BAR_WIDTH))
+    bar = "█" * filled + "░" * (PROGRESS_BAR_WIDTH - filled)
+    text = f"{bar} {int(progress * 100)}%"
+    if eta >= 1:
+        text += f" · осталось ~{int(eta)} с"
+    return text
+
+
+class ProgressMessage:
+    """
+    Показывает прогресс генерации, редактируя статусное сообщение на месте.
+    Обновления приходят от планировщика хоть каждую секунду, а сообщение
+    редактируется не чаще раза в PROGRESS_EDIT_INTERVAL и только при изменении
+    процента, чтобы не упираться в лимиты Telegram. Сообщение можно привязать
+    позже (attach): прогресс, пришедший раньше, покажется сразу после привязки.
+    """
+
+    def __init__(self, text: str, message: Optional[types.Message] = None,
+                 interval: float = PROGRESS_EDIT_INTERVAL):
+        self.text = text
+        self.message = message
+        self.interval = interval
+        self._latest: Optional[Tuple[int, int]] = None
+        self._shown_percent: Optional[int] = None
+        self._next_edit_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def attach(self, message: types.Message):
+        self.message = message
+        if self._latest is not None:
+            self._schedule()
+
+    def __call__(self, progress: float, eta: float):
+        if self._closed:
+            return
+        self._latest = (int(progress * 100), int(eta))
+        if self.message is not None:
+            self._schedule()
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._edit())
+
+    async def _edit(self):
+        # Обновление прогресса не должно задерживать ответы на нажатия кнопок
+        outbound_priority.set(PRIORITY_BULK)
+        delay = self._next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._closed or self._latest is None or self._latest[0] == self._shown_percent:
+            return
+        percent, eta = self._latest
+        self._next_edit_at = time.monotonic() + self.interval
+        try:
+            await self.message.edit_text(f"{self.text}\n{format_progress(percent / 100, eta)}")
+            self._shown_percent = percent
+        except TelegramRetryAfter as e:
+            # Повторы уже исчерпал конвейер отправки - просто откладываем следующее обновление
+            self._next_edit_at = time.monotonic() + e.retry_after
+        except TelegramBadRequest:
+            # Сообщение уже удалено или не изменилось - прогресс просто не показываем
+            pass
+
+    def close(self):
+        """Прекращает обновления (генерация завершена или отменена)."""
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
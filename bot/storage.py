@@ -0,0 +1,170 @@
+# bot/storage.py
+import asyncio
+import copy
+import json
+import sqlite3
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+# Данные FSM длиннее этого порога сжимаются zlib
+COMPRESS_THRESHOLD = 256
+
+
+def _encode_data(data: Dict[str, Any]) -> Optional[bytes]:
+    """Компактная запись данных: JSON без пробелов, крупные значения - через zlib."""
+    if not data:
+        return None
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+
+def _decode_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return json.loads(raw)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Постоянное хранилище FSM в SQLite. Активные сессии держатся в ограниченном
+    LRU-кэше в памяти, изменения пачками сбрасываются на диск фоновой задачей,
+    поэтому перезапуск бота не сбрасывает пользователям начатые сценарии.
+    """
+
+    def __init__(self, path: Path, cache_size: int = 10000, flush_interval: float = 0.5):
+        self.path = Path(path)
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        # ключ -> (состояние, данные); порядок = давность использования
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any]]]" = OrderedDict()
+        # Еще не записанные на диск изменения
+        self._dirty: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        # ключ -> идущее чтение с диска
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def _make_key(key: StorageKey) -> str:
+        business_connection_id = getattr(key, "business_connection_id", None)
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, business_connection_id, key.destiny
+        ))
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data BLOB)")
+            self._connection = conn
+        return self._connection
+
+    def _read_row(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        row = self._get_connection().execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], _decode_data(row[1])
+
+    def _write_rows(self, rows: Dict[str, Tuple[Optional[str], Dict[str, Any]]]):
+        conn = self._get_connection()
+        with conn:
+            for key, (state, data) in rows.items():
+                if state is None and not data:
+                    conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+                else:
+                    conn.execute(
+                        "INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data",
+                        (key, state, _encode_data(data))
+                    )
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        while True:
+            record = self._cache.get(key)
+            if record is not None:
+                self._cache.move_to_end(key)
+                return record
+            record = self._dirty.get(key)
+            if record is not None:
+                self._remember(key, record)
+                return record
+            # Одно чтение с диска на ключ: параллельные запросы ждут его же
+            reading = self._loading.get(key)
+            if reading is None:
+                reading = self._loading[key] = asyncio.ensure_future(self._read(key))
+            await asyncio.shield(reading)
+            # Пока ждали, ключ могли записать: перечитываем из памяти
+
+    async def _read(self, key: str):
+        try:
+            async with self._lock:
+                record = await asyncio.to_thread(self._read_row, key)
+            # Свежая запись, сделанная во время чтения, важнее прочитанной с диска
+            if key not in self._cache and key not in self._dirty:
+                self._remember(key, record)
+        finally:
+            self._loading.pop(key, None)
+
+    def _remember(self, key: str, record: Tuple[Optional[str], Dict[str, Any]]):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            # Вытесняем только из памяти: несохраненное лежит в _dirty до записи
+            self._cache.popitem(last=False)
+
+    def _store(self, key: str, record: Tuple[Optional[str], Dict[str, Any]]):
+        self._remember(key, record)
+        self._dirty[key] = record
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Записывает накопленные изменения на диск одной транзакцией."""
+        if not self._dirty:
+            return
+        rows, self._dirty = self._dirty, {}
+        async with self._lock:
+            await asyncio.to_thread(self._write_rows, rows)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._make_key(key)
+        _, data = await self._load(storage_key)
+        state_name = state.state if isinstance(state, State) else state
+        self._store(storage_key, (state_name, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._make_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._make_key(key)
+        state, _ = await self._load(storage_key)
+        self._store(storage_key, (state, copy.deepcopy(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._make_key(key))
+        return copy.deepcopy(data)
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            # Не прерываем запись на полпути: дожидаемся отложенного сброса
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
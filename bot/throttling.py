@@ -0,0 +1,167 @@
+# bot/throttling.py
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+import config
+from services import metrics
+
+# Приоритет исходящих сообщений: ответы на действия пользователя идут раньше массовой выдачи
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Задача, рассылающая результаты пакета, выставляет себе PRIORITY_BULK
+outbound_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+# Методы, которые Telegram считает отправкой сообщений в чат. Остальные
+# (answerCallbackQuery, getChatMember, deleteMessage и т.д.) не ограничиваются.
+LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "sendAnimation", "sendVideo",
+    "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+}
+
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Классическое ведро токенов: rate токенов в секунду, не больше capacity за раз."""
+    __slots__ = ("rate", "capacity", "tokens", "updated_at", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # До этого момента Telegram велел не слать (RetryAfter)
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 - можно отправлять сейчас)."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutboundThrottle(BaseRequestMiddleware):
+    """
+    Единый конвейер исходящих запросов к Telegram. Отправки сообщений проходят
+    через общее ведро (~30 сообщений/с на бота) и ведро своего чата (~1/с в личке,
+    20/мин в группах). Пока ждут интерактивные ответы, массовая выдача пакетов
+    стоит. TelegramRetryAfter выдерживается автоматически, и запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_chats = max_chats
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._interactive_waiting = 0
+        self._no_interactive = asyncio.Event()
+        self._no_interactive.set()
+        self.stats = {"throttled": 0, "retry_after": 0}
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # Забываем чаты, ведра которых уже полные: их состояние восстановится само
+                now = time.monotonic()
+                self._chats = {key: b for key, b in self._chats.items() if not b.is_idle(now)}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 1 if is_group else self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _set_interactive_waiting(self, waiting: bool):
+        self._interactive_waiting += 1 if waiting else -1
+        if self._interactive_waiting:
+            self._no_interactive.clear()
+        else:
+            self._no_interactive.set()
+
+    async def acquire(self, chat_id: Optional[Union[int, str]], priority: int):
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        interactive = priority == PRIORITY_INTERACTIVE
+        # Интерактивная отправка придерживает массовую выдачу, только пока сама ждет
+        # общее ведро: ожидание своего чата (или его RetryAfter) чужие чаты не касается
+        waiting_global = False
+        try:
+            while True:
+                if not interactive:
+                    await self._no_interactive.wait()
+                now = time.monotonic()
+                global_wait = self.global_bucket.delay(now)
+                chat_wait = chat_bucket.delay(now) if chat_bucket is not None else 0.0
+                if global_wait <= 0 and chat_wait <= 0:
+                    self.global_bucket.take()
+                    if chat_bucket is not None:
+                        chat_bucket.take()
+                    return
+                if interactive and waiting_global != (chat_wait <= 0):
+                    waiting_global = not waiting_global
+                    self._set_interactive_waiting(waiting_global)
+                self.stats["throttled"] += 1
+                await asyncio.sleep(chat_wait if chat_wait > 0 else global_wait)
+        finally:
+            if waiting_global:
+                self._set_interactive_waiting(False)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if method.__api_method__ not in LIMITED_METHODS:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS):
+            await self.acquire(chat_id, outbound_priority.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt + 1 >= MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+                self.stats["retry_after"] += 1
+                # Блокируем ведро чата (или общее, если чата нет), чтобы остальные тоже подождали
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + e.retry_after)
+                print(f"Telegram просит подождать {e.retry_after} с перед {method.__api_method__}")
+
+
+outbound_throttle = OutboundThrottle(
+    global_rate=getattr(config, "TELEGRAM_GLOBAL_RATE", 30),
+    chat_rate=getattr(config, "TELEGRAM_CHAT_RATE", 1),
+    chat_burst=getattr(config, "TELEGRAM_CHAT_BURST", 3),
+    group_rate=getattr(config, "TELEGRAM_GROUP_RATE", 20 / 60),
+)
+
+metrics.Counter("telegram_throttled_total", "Отправки, отложенные ограничителем скорости.",
+                collect=lambda: outbound_throttle.stats["throttled"])
+metrics.Counter("telegram_retry_after_total", "Ответы Telegram RetryAfter.",
+                collect=lambda: outbound_throttle.stats["retry_after"])
@@ -0,0 +1,69 @@
+# bot/webhook.py
+import asyncio
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+import config
+
+# Публичный адрес, по которому Telegram будет слать апдейты (https, порт 443/80/88/8443)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+# За обратным прокси (nginx, caddy) сервер слушает только локальный интерфейс
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+# Telegram передает его в заголовке X-Telegram-Bot-Api-Secret-Token, чужие запросы отклоняются
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+# Сколько соединений Telegram держит к вебхуку одновременно (1-100)
+WEBHOOK_MAX_CONNECTIONS = getattr(config, "WEBHOOK_MAX_CONNECTIONS", 40)
+# Если несколько процессов бота стоят за одним адресом, вебхук регистрирует только один из них
+WEBHOOK_REGISTER = getattr(config, "WEBHOOK_REGISTER", True)
+
+
+def webhook_endpoint() -> str:
+    return WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+
+
+async def register_webhook(bot: Bot, dp: Dispatcher):
+    """Сообщает Telegram адрес вебхука и типы апдейтов, которые бот обрабатывает."""
+    await bot.set_webhook(
+        webhook_endpoint(),
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=True,
+    )
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """
+    Принимает апдейты через aiohttp-сервер. Каждый апдейт обрабатывается в фоне:
+    Telegram сразу получает ответ 200 и может слать следующие, не дожидаясь генерации.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE = \"webhook\" нужно указать WEBHOOK_URL в config.py")
+    if not WEBHOOK_SECRET:
+        print("WEBHOOK_SECRET не задан: вебхук примет запрос от кого угодно, кто знает адрес.")
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=WEBHOOK_PATH)
+    # Запуск и остановка сервера вызывают dp.startup/dp.shutdown и закрывают сессию бота
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+        await site.start()
+        if WEBHOOK_REGISTER:
+            await register_webhook(bot, dp)
+        print(f"Бот запущен! Вебхук {webhook_endpoint()} -> {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -2,8 +2,11 @@
 import asyncio
 import logging
 import sys
+from pathlib import Path
+from typing import Optional
 
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 
 try:
@@ -14,7 +17,71 @@ except ImportError:
     sys.exit(1)
 
 from bot.handlers import user_handlers, admin_handlers
-from bot.middleware import AccessMiddleware # <-- Обновлено название Middleware
+from bot.middleware import (  # <-- Обновлено название Middleware
+    AccessMiddleware, ConcurrencyLimitMiddleware, HandlerMetricsMiddleware, UpdateMetricsMiddleware
+)
+from bot.delivery import file_id_cache
+from bot.storage import SQLiteStorage
+from bot.throttling import outbound_throttle
+from bot.webhook import run_webhook
+from services import a1111_api_service, metrics
+from services.backend_pool import backend_pool
+from services.catalog_service import catalog
+from services.generation_scheduler import scheduler
+from services.image_cache import image_cache
+from services.image_processing import shutdown_pool
+from services.progress_monitor import progress_monitor
+from services.settings_service import flush_settings
+
+def create_storage():
+    """Хранилище FSM выбирается в config.FSM_STORAGE: "sqlite" (по умолчанию) или "memory"."""
+    if getattr(config, "FSM_STORAGE", "sqlite") == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(
+        Path(getattr(config, "FSM_DB_PATH", Path(__file__).parent / "data" / "fsm.db")),
+        cache_size=getattr(config, "FSM_CACHE_SIZE", 10000),
+    )
+
+def create_dispatcher(storage: Optional[BaseStorage] = None) -> Dispatcher:
+    """Диспетчер со всеми middleware, роутерами и обработчиками запуска/остановки (его же гоняет нагрузочный тест)."""
+    dp = Dispatcher(storage=storage or create_storage())
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+
+    # Апдейты обрабатываются параллельными задачами, их число ограничено.
+    # Генерации ждут фоновые задачи, поэтому обработчики держат слот недолго.
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(getattr(config, "MAX_CONCURRENT_UPDATES", 100)))
+
+    # Регистрируем наш обновленный Middleware
+    # Он будет применяться ко всем сообщениям и колбэкам
+    dp.update.middleware(AccessMiddleware())
+
+    # Регистрация роутеров. Роутер админа должен идти первым
+    dp.include_router(admin_handlers.router)
+    dp.include_router(user_handlers.router)
+    # Время работы обработчиков по роутерам (для /metrics)
+    for name, router in (("admin", admin_handlers.router), ("user", user_handlers.router)):
+        router.message.middleware(HandlerMetricsMiddleware(name))
+        router.callback_query.middleware(HandlerMetricsMiddleware(name))
+
+    # Каталог моделей и семплеров A1111 обновляется в фоне, здоровье бэкендов проверяется периодически.
+    # Индекс дискового кэша изображений строится до первых апдейтов, в отдельном потоке
+    dp.startup.register(image_cache.load)
+    dp.startup.register(catalog.start)
+    dp.startup.register(backend_pool.start)
+    dp.startup.register(metrics.start_server)
+
+    # При остановке гасим очередь генераций и закрываем пул соединений к A1111
+    dp.shutdown.register(catalog.stop)
+    dp.shutdown.register(metrics.stop_server)
+    dp.shutdown.register(scheduler.shutdown)
+    dp.shutdown.register(backend_pool.stop)
+    dp.shutdown.register(progress_monitor.stop)
+    dp.shutdown.register(shutdown_pool)
+    dp.shutdown.register(a1111_api_service.close_session)
+    # и сохраняем file_id уже загруженных в Telegram изображений и несохраненные настройки
+    dp.shutdown.register(file_id_cache.close)
+    dp.shutdown.register(flush_settings)
+    return dp
 
 async def main():
     # Настройка логирования для отладки
@@ -24,23 +91,22 @@ async def main():
     )
 
     # Инициализация бота и диспетчера
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = create_dispatcher()
     bot = Bot(token=config.BOT_TOKEN)
+    # Все отправки сообщений идут через общий ограничитель скорости Telegram
+    bot.session.middleware(outbound_throttle)
 
-    # Регистрируем наш обновленный Middleware
-    # Он будет применяться ко всем сообщениям и колбэкам
-    dp.update.middleware(AccessMiddleware())
+    # Режим получения апдейтов: "polling" (по умолчанию) или "webhook"
+    if getattr(config, "BOT_MODE", "polling") == "webhook":
+        await run_webhook(bot, dp)
+        return
 
-    # Регистрация роутеров. Роутер админа должен идти первым
-    dp.include_router(admin_handlers.router)
-    dp.include_router(user_handlers.router)
-    
     # Удаляем вебхуки, если они были установлены ранее
     await bot.delete_webhook(drop_pending_updates=True)
     
     # Запускаем polling
     print("Бот запущен!")
-    await dp.start_polling(bot)
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 if __name__ == "__main__":
     try:
@@ -1,51 +1,336 @@
 # services/a1111_api_service.py
-import requests
-import base64
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import re
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple
+
+import aiohttp
+
 import config
-from typing import Optional, List, Dict
+from services import metrics
+from services.txt2img_stream import Txt2ImgStreamParser, decode_image
+
+# Таймауты (в секундах) для каждого эндпоинта A1111
+ENDPOINT_TIMEOUTS = {
+    "refresh-checkpoints": 60,
+    "sd-models": 10,
+    "samplers": 10,
+    "loras": 10,
+    "refresh-loras": 60,
+    "embeddings": 10,
+    "options": 120,
+    "txt2img": 300,
+    "interrupt": 5,
+    "progress": 5,
+}
+DEFAULT_TIMEOUT = 30
+# Размер порции при потоковом чтении ответа txt2img
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Общая сессия с пулом keep-alive соединений (создается лениво внутри event loop)
+_session: Optional[aiohttp.ClientSession] = None
+# Отдельная маленькая сессия для проверок здоровья, опроса прогресса и прерываний:
+# долгие txt2img занимают соединения основной сессии и не должны их задерживать
+_control_session: Optional[aiohttp.ClientSession] = None
+# Служебные запросы управления - по эндпоинтам (они идут через _control_session)
+CONTROL_ENDPOINTS = {"progress", "interrupt"}
+
+# Какой чекпоинт загружен на каждом бэкенде (ключ - базовый URL A1111)
+_loaded_checkpoints: Dict[str, str] = {}
+# Отправленные при отмене запросы /interrupt: дожидаемся их перед закрытием сессий
+_interrupt_tasks = set()
+_checkpoint_locks: Dict[str, asyncio.Lock] = {}
+
+# Статистика переключений моделей: сколько раз и сколько секунд GPU потратил на смену чекпоинта
+model_swap_stats = {"count": 0, "seconds": 0.0}
+
+A1111_LATENCY = metrics.Histogram("a1111_request_seconds", "Время запросов к A1111 по эндпоинтам.", ["endpoint"])
+A1111_ERRORS = metrics.Counter("a1111_request_errors_total", "Запросы к A1111, завершившиеся ошибкой.", ["endpoint"])
+metrics.Counter("a1111_model_swaps_total", "Переключения чекпоинта на бэкендах.",
+                collect=lambda: model_swap_stats["count"])
+metrics.Counter("a1111_model_swap_seconds_total", "Время, потраченное на переключение чекпоинтов.",
+                collect=lambda: model_swap_stats["seconds"])
+
+
+class BackendUnavailableError(Exception):
+    """Бэкенд A1111 недоступен (нет соединения или истек таймаут); задачу можно отдать другому."""
+
+    def __init__(self, base_url: str, reason: Exception):
+        super().__init__(f"{base_url}: {reason!r}")
+        self.base_url = base_url
+        self.reason = reason
+
+
+class GenerationResult:
+    """
+    Готовое изображение, его хэш содержимого и seed, с которым оно получено.
+    Если изображение лежит на диске (path), байты читаются только при обращении к image.
+    """
+    __slots__ = ("_image", "path", "seed", "content_hash", "from_cache")
+
+    def __init__(self, image: Optional[bytes], seed: int, content_hash: Optional[str] = None,
+                 from_cache: bool = False, path: Optional[Path] = None):
+        self._image = image
+        self.path = path
+        self.seed = seed
+        self.content_hash = content_hash or hashlib.sha256(self.image).hexdigest()
+        self.from_cache = from_cache
+
+    @property
+    def image(self) -> bytes:
+        if self._image is None and self.path is not None:
+            self._image = self.path.read_bytes()
+        return self._image
+
+    @property
+    def size(self) -> int:
+        return self.path.stat().st_size if self._image is None and self.path is not None else len(self._image)
+
+
+def _hash_file(path: Path) -> str:
+    """Хэш файла через mmap: содержимое не копируется в память процесса (выполняется в потоке)."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return hashlib.sha256(mapped).hexdigest()
+
+
+def _find_output_file(outputs_dir: Path, seed: int, started_at: float) -> Optional[Path]:
+    """
+    Ищет PNG, который A1111 сохранил после started_at: в папке дня (по умолчанию
+    A1111 раскладывает по датам) или в самой outputs_dir, с seed в имени файла
+    (шаблон по умолчанию "00012-<seed>.png").
+    """
+    name_pattern = re.compile(rf"(^|-){seed}(-|\.png$)")
+    today = date.today()
+    best, best_mtime = None, started_at - 1
+    for directory in (outputs_dir / today.isoformat(), outputs_dir / (today - timedelta(days=1)).isoformat(), outputs_dir):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if not entry.name.endswith(".png") or not name_pattern.search(entry.name):
+                continue
+            mtime = entry.stat().st_mtime
+            if mtime >= best_mtime:
+                best, best_mtime = Path(entry.path), mtime
+    return best
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую HTTP-сессию, создавая ее при первом обращении. Предел
+    соединений задан на каждый бэкенд, а не общий: рендеры одного сервера не
+    отнимают соединения у другого.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=getattr(config, "A1111_MAX_CONNECTIONS", 8),
+            keepalive_timeout=60,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
 
-def get_available_models() -> List[str]:
+
+def _get_control_session() -> aiohttp.ClientSession:
+    global _control_session
+    if _control_session is None or _control_session.closed:
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=2, keepalive_timeout=60)
+        _control_session = aiohttp.ClientSession(connector=connector)
+    return _control_session
+
+
+async def close_session():
+    """Закрывает HTTP-сессии (вызывается при остановке бота)."""
+    global _session, _control_session
+    if _interrupt_tasks:
+        await asyncio.gather(*_interrupt_tasks, return_exceptions=True)
+    for session in (_session, _control_session):
+        if session is not None and not session.closed:
+            await session.close()
+    _session = _control_session = None
+
+
+def _endpoint(endpoint: str, base_url: str) -> Tuple[str, aiohttp.ClientTimeout]:
+    # Адрес бэкенда всегда выбирает вызывающий (через пул), запасного адреса по умолчанию нет
+    url = f"{base_url}/sdapi/v1/{endpoint}"
+    return url, aiohttp.ClientTimeout(total=ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+
+
+async def _request(method: str, endpoint: str, base_url: str, **kwargs) -> Any:
+    """Выполняет запрос к /sdapi/v1/<endpoint> с таймаутом, заданным для эндпоинта."""
+    url, timeout = _endpoint(endpoint, base_url)
+    started = time.perf_counter()
+    try:
+        session = _get_control_session() if endpoint in CONTROL_ENDPOINTS else _get_session()
+        async with session.request(method, url, timeout=timeout, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+    except Exception:
+        A1111_ERRORS.inc(endpoint)
+        raise
+    finally:
+        A1111_LATENCY.observe(time.perf_counter() - started, endpoint)
+
+
+async def _stream_txt2img(base_url: str, payload: dict) -> Txt2ImgStreamParser:
+    """
+    Выполняет txt2img, разбирая ответ по мере чтения: тело целиком в памяти
+    не собирается и json.loads по нему не вызывается.
+    """
+    url, timeout = _endpoint("txt2img", base_url)
+    parser = Txt2ImgStreamParser()
+    started = time.perf_counter()
+    try:
+        async with _get_session().post(url, json=payload, timeout=timeout) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                parser.feed(chunk)
+    except Exception:
+        A1111_ERRORS.inc("txt2img")
+        raise
+    finally:
+        A1111_LATENCY.observe(time.perf_counter() - started, "txt2img")
+    return parser
+
+
+async def get_available_models(base_url: str, rescan: bool = True) -> List[str]:
     """Получает список доступных моделей (файлов) из A1111."""
-    # ИСПОЛЬЗУЕМ ДРУГОЙ, БОЛЕЕ УНИВЕРСАЛЬНЫЙ АДРЕС API
-    api_url = f"{config.A1111_API_URL}/sdapi/v1/refresh-checkpoints"
     try:
-        # Этот запрос заставляет A1111 обновить список и возвращает его
-        response = requests.post(url=api_url, timeout=10)
-        response.raise_for_status()
-        
+        if rescan:
+            # Этот запрос заставляет A1111 обновить список моделей на диске
+            await _request("POST", "refresh-checkpoints", base_url=base_url)
         # Теперь получаем сам список моделей
-        api_url_get = f"{config.A1111_API_URL}/sdapi/v1/sd-models"
-        response_get = requests.get(url=api_url_get, timeout=10)
-        response_get.raise_for_status()
-
-        models = response_get.json()
+        models = await _request("GET", "sd-models", base_url=base_url)
         return [model["model_name"] for model in models]
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"Ошибка получения списка моделей из A1111: {e}")
         return []
 
-def set_active_model(model_filename: str) -> bool:
+
+async def get_samplers(base_url: str) -> List[str]:
+    """Получает список семплеров, которые поддерживает A1111."""
+    try:
+        samplers = await _request("GET", "samplers", base_url=base_url)
+        return [sampler["name"] for sampler in samplers]
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Ошибка получения списка семплеров из A1111: {e}")
+        return []
+
+
+async def get_loras(base_url: str, rescan: bool = False) -> List[str]:
+    """Получает список LoRA из A1111 (пустой, если расширение LoRA недоступно)."""
+    try:
+        if rescan:
+            await _request("POST", "refresh-loras", base_url=base_url)
+        loras = await _request("GET", "loras", base_url=base_url)
+        return [lora["name"] for lora in loras]
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Ошибка получения списка LoRA из A1111: {e}")
+        return []
+
+
+async def get_embeddings(base_url: str) -> List[str]:
+    """Получает список загруженных текстовых эмбеддингов из A1111."""
+    try:
+        embeddings = await _request("GET", "embeddings", base_url=base_url)
+        return sorted(embeddings.get("loaded", {}))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Ошибка получения списка эмбеддингов из A1111: {e}")
+        return []
+
+
+def _normalize_checkpoint(name: str) -> str:
+    """Приводит заголовок чекпоинта ('dir/model.safetensors [hash]') к виду model_name из /sd-models."""
+    name = name.split(" [")[0]
+    for ext in (".safetensors", ".ckpt"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name.replace("/", "_").replace("\\", "_")
+
+
+def get_loaded_checkpoint(base_url: str) -> Optional[str]:
+    """Возвращает модель, которая, по нашим данным, загружена на бэкенде."""
+    return _loaded_checkpoints.get(base_url)
+
+
+async def set_active_model(model_filename: str, base_url: str) -> bool:
     """Устанавливает активную модель в A1111."""
-    api_url = f"{config.A1111_API_URL}/sdapi/v1/options"
     payload = {"sd_model_checkpoint": model_filename}
     try:
-        response = requests.post(url=api_url, json=payload, timeout=60)
-        response.raise_for_status()
+        await _request("POST", "options", base_url=base_url, json=payload)
+        _loaded_checkpoints[base_url] = model_filename
         return True
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _loaded_checkpoints.pop(base_url, None)
         print(f"Ошибка установки модели {model_filename} в A1111: {e}")
         return False
 
-def generate_image(positive_prompt: str, negative_prompt: str, settings: dict) -> Optional[bytes]:
-    """Отправляет запрос на генерацию изображения в Automatic1111 API."""
-    # Сначала убедимся, что установлена нужная модель
-    model_to_set = settings.get("model_name")
-    if not model_to_set or not set_active_model(model_to_set):
-        print("Не удалось установить модель перед генерацией.")
-        # Можно либо прервать, либо генерировать с текущей моделью
-        # Мы продолжим, но в логах будет ошибка
-    
-    api_url = f"{config.A1111_API_URL}/sdapi/v1/txt2img"
+
+async def ensure_model_loaded(model_name: str, base_url: str) -> bool:
+    """
+    Загружает модель на бэкенде, только если там сейчас загружена другая.
+    Время и количество переключений попадают в model_swap_stats.
+    """
+    lock = _checkpoint_locks.setdefault(base_url, asyncio.Lock())
+    async with lock:
+        if base_url not in _loaded_checkpoints:
+            # Первый запрос к бэкенду: узнаем, какая модель уже загружена
+            try:
+                options = await _request("GET", "options", base_url=base_url)
+                current = options.get("sd_model_checkpoint")
+                if current:
+                    _loaded_checkpoints[base_url] = _normalize_checkpoint(current)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Не удалось узнать текущую модель A1111: {e}")
+
+        if _loaded_checkpoints.get(base_url) == model_name:
+            return True
+
+        started = time.monotonic()
+        if not await set_active_model(model_name, base_url=base_url):
+            return False
+        model_swap_stats["count"] += 1
+        model_swap_stats["seconds"] += time.monotonic() - started
+        return True
+
+
+async def probe_backend(base_url: str) -> bool:
+    """Быстрая проверка, что бэкенд отвечает (используется пулом бэкендов)."""
+    try:
+        await _request("GET", "progress", base_url=base_url, params={"skip_current_image": "true"})
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+
+
+async def get_progress(base_url: str) -> Optional[Dict[str, Any]]:
+    """Прогресс текущей генерации на бэкенде (без превью, чтобы не гонять картинку)."""
+    try:
+        return await _request("GET", "progress", base_url=base_url, params={"skip_current_image": "true"})
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def interrupt_generation(base_url: str) -> bool:
+    """Просит A1111 прервать текущую генерацию."""
+    try:
+        await _request("POST", "interrupt", base_url=base_url)
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Ошибка при прерывании генерации в A1111: {e}")
+        return False
+
+
+def build_txt2img_payload(positive_prompt: str, negative_prompt: str, settings: dict) -> dict:
+    """Собирает тело запроса txt2img из промтов и настроек пользователя."""
     payload = {
         "prompt": positive_prompt,
         "negative_prompt": negative_prompt,
@@ -54,16 +339,98 @@ def generate_image(positive_prompt: str, negative_prompt: str, settings: dict) -
         "cfg_scale": float(settings.get("cfg_scale", 7.0)),
         "width": int(settings.get("width", 512)),
         "height": int(settings.get("height", 768)),
+        "seed": int(settings.get("seed", -1)),
         "save_images": True
     }
+    model_name = settings.get("model_name")
+    if model_name:
+        # override_settings привязывает модель к самому запросу: даже если чужой
+        # запрос успел сменить чекпоинт, эта генерация пойдет на нужной модели
+        payload["override_settings"] = {"sd_model_checkpoint": model_name}
+        payload["override_settings_restore_afterwards"] = False
+    return payload
+
+
+def get_request_key(positive_prompt: str, negative_prompt: str, settings: dict) -> str:
+    """Канонический хэш запроса: одинаковые промты, настройки, модель и seed дают один ключ."""
+    payload = build_txt2img_payload(positive_prompt, negative_prompt, settings)
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _extract_seed(response: Txt2ImgStreamParser, requested_seed: int) -> int:
+    """
+    Достает фактический seed из infotext ответа. Метаданные ответа разбираются
+    только здесь и только когда seed был случайным.
+    """
+    if requested_seed >= 0:
+        return requested_seed
+    try:
+        return int(response.info().get("seed", requested_seed))
+    except (ValueError, TypeError):
+        return requested_seed
+
+
+async def generate_image(positive_prompt: str, negative_prompt: str, settings: dict,
+                         base_url: str, outputs_dir: Optional[Path] = None,
+                         interrupt_on_cancel: bool = False) -> Optional[GenerationResult]:
+    """
+    Отправляет запрос на генерацию изображения в Automatic1111 API.
+    Возвращает None, если A1111 ответил ошибкой или не уложился в таймаут, и бросает
+    BackendUnavailableError, если к бэкенду не удалось подключиться.
+    outputs_dir задается для бэкенда на этой же машине: тогда A1111 не присылает
+    изображение по HTTP, а результат берется из сохраненного им файла.
+    interrupt_on_cancel: при отмене прервать рендер на бэкенде. /interrupt останавливает
+    текущую генерацию A1111, какой бы она ни была, поэтому включать его можно только
+    там, где на бэкенде не рендерится ничего, кроме этой задачи.
+    """
+    payload = build_txt2img_payload(positive_prompt, negative_prompt, settings)
+    if outputs_dir is not None:
+        payload["send_images"] = False
+
+    model_name = settings.get("model_name")
+    if model_name:
+        # Переключаем чекпоинт, только если загружен другой
+        if not await ensure_model_loaded(model_name, base_url=base_url):
+            print("Не удалось установить модель перед генерацией.")
+    else:
+        print("Модель не выбрана, генерация пойдет на текущей модели A1111.")
+
+    started_at = time.time()
     try:
-        response = requests.post(url=api_url, json=payload, timeout=300)
-        response.raise_for_status()
-        r = response.json()
-        if 'images' in r and r['images']:
-            image_data = base64.b64decode(r['images'][0])
-            return image_data
+        r = await _stream_txt2img(base_url, payload)
+    except asyncio.CancelledError:
+        if interrupt_on_cancel:
+            # Задачу отменили: просим A1111 не тратить GPU на ненужный результат
+            task = asyncio.ensure_future(interrupt_generation(base_url))
+            _interrupt_tasks.add(task)
+            task.add_done_callback(_interrupt_tasks.discard)
+        raise
+    except aiohttp.ClientConnectorError as e:
+        _loaded_checkpoints.pop(base_url, None)
+        raise BackendUnavailableError(base_url, e) from e
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Долгий рендер или обрыв на работающем сервере: GPU из пула не выводим
+        # Состояние бэкенда неизвестно - при следующем запросе уточним модель заново
+        _loaded_checkpoints.pop(base_url, None)
+        print(f"Ошибка при генерации изображения: {e!r}")
         return None
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при генерации изображения: {e}")
-        return None
\ No newline at end of file
+
+    if model_name:
+        _loaded_checkpoints[base_url] = model_name
+    if outputs_dir is not None:
+        seed = _extract_seed(r, payload["seed"])
+        path = await asyncio.to_thread(_find_output_file, Path(outputs_dir), seed, started_at)
+        if path is None:
+            print(f"Не найден файл изображения с seed {seed} в {outputs_dir}. Проверьте A1111_OUTPUTS_DIR.")
+            return None
+        content_hash = await asyncio.to_thread(_hash_file, path)
+        return GenerationResult(None, seed, content_hash, path=path)
+    if r.images:
+        # Декодирование крупного base64 выносим из event loop; остальные изображения не нужны
+        image_b64 = r.images[0]
+        r.images.clear()
+        image, content_hash = await asyncio.to_thread(decode_image, image_b64)
+        del image_b64
+        return GenerationResult(image, _extract_seed(r, payload["seed"]), content_hash)
+    return None
@@ -0,0 +1,180 @@
+# services/backend_pool.py
+import asyncio
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import config
+from services import metrics
+from services.a1111_api_service import get_loaded_checkpoint, probe_backend
+
+
+class Backend:
+    """
+    Один сервер A1111: адрес, лимит одновременных задач и состояние здоровья.
+    outputs_dir - папка txt2img-images этого A1111, если он работает на той же машине.
+    """
+    __slots__ = ("url", "concurrency", "outputs_dir", "active", "healthy", "failures", "checked_at")
+
+    def __init__(self, url: str, concurrency: int = 1, outputs_dir: Optional[Union[str, Path]] = None):
+        self.url = url.rstrip("/")
+        self.concurrency = max(1, concurrency)
+        self.outputs_dir = Path(outputs_dir) if outputs_dir else None
+        self.active = 0
+        # До первой проверки считаем бэкенд рабочим, чтобы не задерживать первые запросы
+        self.healthy = True
+        self.failures = 0
+        self.checked_at: Optional[float] = None
+
+    @property
+    def free_slots(self) -> int:
+        return self.concurrency - self.active if self.healthy else 0
+
+    @property
+    def load(self) -> float:
+        return self.active / self.concurrency
+
+    @property
+    def loaded_model(self) -> Optional[str]:
+        return get_loaded_checkpoint(self.url)
+
+
+class BackendPool:
+    """
+    Пул серверов A1111. Задача отдается наименее загруженному здоровому бэкенду,
+    а при прочих равных - тому, где уже загружен нужный чекпоинт. Недоступные
+    бэкенды выводятся из пула и возвращаются фоновой проверкой здоровья.
+    """
+
+    def __init__(self, backends: Iterable[Backend], probe_interval: float = 15, outage_grace: float = 60):
+        self.backends: List[Backend] = list(backends)
+        self.probe_interval = probe_interval
+        # Сколько задачи ждут в очереди восстановления, когда недоступны все бэкенды
+        self.outage_grace = outage_grace
+        self.down_since: Optional[float] = None
+        # Срабатывает, когда освобождается слот или бэкенд снова становится здоровым
+        self._changed: Optional[asyncio.Event] = None
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def _event(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def _notify(self):
+        self._event().set()
+
+    async def wait_for_change(self):
+        event = self._event()
+        event.clear()
+        await event.wait()
+
+    def has_healthy(self) -> bool:
+        return any(backend.healthy for backend in self.backends)
+
+    def outage_grace_left(self) -> float:
+        """Сколько еще ждать восстановления, если лежат все бэкенды (0 - ждать больше нечего)."""
+        if self.down_since is None:
+            return 0.0
+        return max(0.0, self.down_since + self.outage_grace - time.monotonic())
+
+    def has_capacity(self) -> bool:
+        return any(backend.free_slots > 0 for backend in self.backends)
+
+    def free_models(self) -> set:
+        """Чекпоинты, загруженные на бэкендах со свободным слотом (для группировки задач по модели)."""
+        return {backend.loaded_model for backend in self.backends
+                if backend.free_slots > 0 and backend.loaded_model}
+
+    def acquire(self, model_name: Optional[str] = None) -> Optional[Backend]:
+        """
+        Занимает слот на лучшем бэкенде: сначала тот, где уже загружена модель,
+        затем наименее загруженный. None, если свободных слотов нет.
+        """
+        candidates = [backend for backend in self.backends if backend.free_slots > 0]
+        if not candidates:
+            return None
+        backend = min(candidates, key=lambda b: (not model_name or b.loaded_model != model_name, b.load))
+        backend.active += 1
+        return backend
+
+    def by_preference(self) -> List[Backend]:
+        """Бэкенды для служебных запросов (каталог): сначала здоровые и свободные, недоступные - в конце."""
+        return sorted(self.backends, key=lambda b: (not b.healthy, b.load))
+
+    def release(self, backend: Backend):
+        backend.active = max(0, backend.active - 1)
+        self._notify()
+
+    def mark_failed(self, backend: Backend):
+        """Выводит бэкенд из пула до следующей успешной проверки."""
+        backend.failures += 1
+        if backend.healthy:
+            backend.healthy = False
+            print(f"Бэкенд A1111 {backend.url} недоступен, задачи переводятся на другие серверы.")
+            if not self.has_healthy() and self.down_since is None:
+                self.down_since = time.monotonic()
+
+    async def _probe(self, backend: Backend):
+        ok = await probe_backend(backend.url)
+        backend.checked_at = time.monotonic()
+        if ok and not backend.healthy:
+            print(f"Бэкенд A1111 {backend.url} снова доступен.")
+            backend.healthy = True
+            self.down_since = None
+            self._notify()
+        elif not ok and backend.healthy and not backend.active:
+            # Занятый рендером сервер может отвечать медленно: его снимет с пула
+            # только ошибка соединения в самой генерации
+            self.mark_failed(backend)
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+            await asyncio.sleep(self.probe_interval)
+
+    async def start(self):
+        """Запускает периодическую проверку здоровья бэкендов (при старте бота)."""
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+
+def _parse_backends(entries: List[Union[str, dict]], default_concurrency: int) -> List[Backend]:
+    """
+    Элемент config.A1111_BACKENDS - либо URL, либо словарь
+    {"url": ..., "concurrency": N, "outputs_dir": ...}.
+    Без A1111_BACKENDS пул состоит из одного config.A1111_API_URL (с A1111_OUTPUTS_DIR).
+    """
+    backends = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            backends.append(Backend(entry["url"], entry.get("concurrency", default_concurrency),
+                                    entry.get("outputs_dir")))
+        else:
+            backends.append(Backend(entry, default_concurrency))
+    return backends
+
+
+backend_pool = BackendPool(
+    _parse_backends(
+        getattr(config, "A1111_BACKENDS", None)
+        or [{"url": config.A1111_API_URL, "outputs_dir": getattr(config, "A1111_OUTPUTS_DIR", None)}],
+        getattr(config, "A1111_CONCURRENCY", 1),
+    ),
+    probe_interval=getattr(config, "A1111_HEALTH_INTERVAL", 15),
+    outage_grace=getattr(config, "A1111_OUTAGE_GRACE", 60),
+)
+
+metrics.Gauge("a1111_backend_up", "Доступен ли бэкенд A1111.", ["backend"],
+              collect=lambda: {(b.url,): int(b.healthy) for b in backend_pool.backends})
+metrics.Gauge("a1111_backend_active", "Занятые слоты бэкенда A1111.", ["backend"],
+              collect=lambda: {(b.url,): b.active for b in backend_pool.backends})
@@ -0,0 +1,103 @@
+# services/catalog_service.py
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+import config
+from services import a1111_api_service
+from services.backend_pool import backend_pool
+
+
+class CapabilityCatalog:
+    """
+    Кэш возможностей A1111: модели, семплеры, LoRA и эмбеддинги.
+    Списки обновляются в фоне раз в interval секунд (без пересканирования диска)
+    или по запросу администратора (с пересканированием), поэтому меню выбора
+    модели и семплера открываются сразу, без похода в A1111.
+    """
+
+    def __init__(self, interval: float = 300):
+        self.interval = interval
+        self.models: List[str] = []
+        self.samplers: List[str] = []
+        self.loras: List[str] = []
+        self.embeddings: List[str] = []
+        self.updated_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self, rescan: bool = False) -> bool:
+        """
+        Перечитывает каталог из A1111. rescan=True заставляет A1111 заново
+        просканировать папки с моделями и LoRA (долго, только по просьбе админа).
+        Возвращает True, если удалось получить хотя бы список моделей.
+        """
+        async with self._lock:
+            # Каталог берется с того же пула, что и рендеры: первый отвечающий бэкенд
+            models = samplers = loras = embeddings = []
+            for backend in backend_pool.by_preference():
+                models, samplers, loras, embeddings = await asyncio.gather(
+                    a1111_api_service.get_available_models(backend.url, rescan=rescan),
+                    a1111_api_service.get_samplers(backend.url),
+                    a1111_api_service.get_loras(backend.url, rescan=rescan),
+                    a1111_api_service.get_embeddings(backend.url),
+                )
+                if models:
+                    break
+                print(f"Каталог A1111 не получен с {backend.url}, пробуем следующий бэкенд.")
+            # Пустой ответ обычно означает ошибку связи: оставляем прежние данные
+            if models:
+                self.models = models
+            if samplers:
+                self.samplers = samplers
+            if loras:
+                self.loras = loras
+            if embeddings:
+                self.embeddings = embeddings
+            if models:
+                self.updated_at = time.time()
+            return bool(models)
+
+    async def get_models(self) -> List[str]:
+        """Список моделей из кэша; при самом первом обращении каталог загружается."""
+        if self.updated_at is None:
+            await self.refresh()
+        return self.models
+
+    async def get_samplers(self) -> List[str]:
+        if self.updated_at is None:
+            await self.refresh()
+        return self.samplers
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Ошибка фонового обновления каталога A1111: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        """Запускает фоновое обновление (вызывается при старте бота)."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "models": len(self.models),
+            "samplers": len(self.samplers),
+            "loras": len(self.loras),
+            "embeddings": len(self.embeddings),
+        }
+
+
+catalog = CapabilityCatalog(interval=getattr(config, "CATALOG_REFRESH_INTERVAL", 300))
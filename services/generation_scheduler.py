@@ -0,0 +1,415 @@
+# services/generation_scheduler.py
+import asyncio
+import time
+from collections import deque, OrderedDict
+from typing import Callable, Deque, Dict, List, Optional
+
+import config
+from services import metrics
+from services.a1111_api_service import BackendUnavailableError, generate_image, get_request_key
+from services.backend_pool import Backend, BackendPool, backend_pool
+from services.image_cache import image_cache
+from services.progress_monitor import progress_monitor
+
+# Получатель прогресса генерации: (доля готовности 0..1, осталось секунд)
+ProgressListener = Callable[[float, float], None]
+
+# Приоритетные полосы очереди: чем меньше число, тем раньше обслуживается
+PRIORITY_ADMIN = 0
+PRIORITY_WHITELIST = 1
+PRIORITY_DEFAULT = 2
+
+QUEUE_WAIT = metrics.Histogram("generation_queue_wait_seconds", "Время ожидания задачи в очереди до бэкенда.",
+                               ["priority"])
+
+
+class GenerationJob:
+    """
+    Одна задача на генерацию изображения. Одинаковые запросы нескольких
+    пользователей склеиваются в одну задачу, у каждого ожидающего свой future.
+    """
+    __slots__ = ("key", "user_id", "positive", "negative", "settings", "priority", "waiters", "enqueued_at",
+                 "attempts", "listeners", "members", "running", "task")
+
+    def __init__(self, key: str, user_id: int, positive: str, negative: str, settings: dict, priority: int):
+        self.key = key
+        self.user_id = user_id
+        self.positive = positive
+        self.negative = negative
+        self.settings = dict(settings)
+        self.priority = priority
+        self.waiters: List[asyncio.Future] = []
+        self.enqueued_at = time.monotonic()
+        # Сколько раз задача уже падала из-за недоступного бэкенда
+        self.attempts = 0
+        self.listeners: List[ProgressListener] = []
+        # Все пользователи, ждущие эту задачу (владелец и присоединившиеся)
+        self.members = {user_id}
+        self.running = False
+        # Задача _run, пока генерация идет на бэкенде
+        self.task: Optional[asyncio.Task] = None
+
+    def add_waiter(self, on_progress: Optional[ProgressListener] = None) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        waiter.add_done_callback(self._on_waiter_done)
+        if on_progress is not None:
+            self.listeners.append(on_progress)
+        return waiter
+
+    def notify_progress(self, progress: float, eta: float):
+        for listener in self.listeners:
+            try:
+                listener(progress, eta)
+            except Exception as e:
+                print(f"Ошибка при передаче прогресса генерации: {e}")
+
+    def _on_waiter_done(self, waiter: asyncio.Future):
+        # Последний ожидающий отменил запрос: рендер больше никому не нужен
+        if waiter.cancelled() and self.task is not None and not self.task.done() and self.is_abandoned():
+            self.task.cancel()
+
+    def is_abandoned(self) -> bool:
+        """Все ожидающие отменили свои запросы."""
+        return all(waiter.cancelled() for waiter in self.waiters)
+
+    def resolve(self, result):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+
+
+class GenerationScheduler:
+    """
+    Единственный владелец GPU-работы. У каждого пользователя своя очередь,
+    пользователи внутри приоритетной полосы обслуживаются по кругу (round-robin),
+    поэтому одиночный запрос не ждет окончания чужого пакета из сотен картинок.
+    Задачи раздаются по свободным слотам пула бэкендов A1111.
+    """
+
+    def __init__(self, pool: BackendPool, affinity_window: int = 8, max_wait: float = 120.0,
+                 max_replay_seeds: int = 10000):
+        self.pool = pool
+        # Сколько пользователей из начала круга просматривать в поисках задачи на уже загруженной модели
+        self.affinity_window = max(1, affinity_window)
+        # Дольше этого задача ждать не должна, даже если ее модель сейчас не загружена
+        self.max_wait = max_wait
+        # приоритет -> {user_id: очередь задач}; порядок ключей = порядок обхода по кругу
+        self._lanes: Dict[int, "OrderedDict[int, Deque[GenerationJob]]"] = {}
+        # Ключ запроса -> задача в очереди или в работе (single-flight)
+        self._inflight: Dict[str, GenerationJob] = {}
+        # (пользователь, ключ запроса со случайным seed) -> seed, с которым A1111 его отрисовал.
+        # Повтор того же запроса этим пользователем берет картинку из кэша, а не рендерит новую
+        self._replay_seeds: "OrderedDict[tuple, int]" = OrderedDict()
+        self.max_replay_seeds = max_replay_seeds
+        self.stats = {"submitted": 0, "coalesced": 0}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running = set()
+        self._cache_tasks = set()
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def submit(self, user_id: int, positive: str, negative: str, settings: dict,
+               priority: int = PRIORITY_DEFAULT, on_progress: Optional[ProgressListener] = None) -> asyncio.Future:
+        """
+        Ставит задачу в очередь пользователя. Возвращает future с GenerationResult (или None).
+        Если такой же запрос уже ждет в очереди или рендерится, новый запрос присоединяется к нему.
+        Запросы, которые уже рендерились, отдаются из кэша без очереди: с фиксированным seed -
+        любому пользователю, со случайным - тому, кто их уже получал (с тем же фактическим seed).
+        on_progress вызывается с прогрессом, пока задача рендерится на бэкенде.
+        """
+        self._ensure_dispatcher()
+        self.stats["submitted"] += 1
+        key = get_request_key(positive, negative, settings)
+        replay_seed = self._replay_seeds.get((user_id, key))
+        if replay_seed is not None and int(settings.get("seed", -1)) < 0:
+            self._replay_seeds.move_to_end((user_id, key))
+            settings = dict(settings, seed=replay_seed)
+            key = get_request_key(positive, negative, settings)
+        if int(settings.get("seed", -1)) >= 0 and image_cache.contains(key):
+            waiter = asyncio.get_running_loop().create_future()
+            task = asyncio.create_task(self._serve_from_cache(waiter, key, user_id, positive, negative, settings,
+                                                              priority, on_progress))
+            self._cache_tasks.add(task)
+            task.add_done_callback(self._cache_tasks.discard)
+            return waiter
+        return self._enqueue(key, user_id, positive, negative, settings, priority, on_progress)
+
+    def _enqueue(self, key: str, user_id: int, positive: str, negative: str, settings: dict,
+                 priority: int, on_progress: Optional[ProgressListener] = None) -> asyncio.Future:
+        job = self._inflight.get(key)
+        if job is not None and not job.is_abandoned():
+            self.stats["coalesced"] += 1
+            if not job.running:
+                self._promote(job, user_id, priority)
+            job.members.add(user_id)
+            return job.add_waiter(on_progress)
+
+        job = GenerationJob(key, user_id, positive, negative, settings, priority)
+        waiter = job.add_waiter(on_progress)
+        self._inflight[key] = job
+        lane = self._lanes.setdefault(priority, OrderedDict())
+        lane.setdefault(user_id, deque()).append(job)
+        self._wakeup.set()
+        return waiter
+
+    async def _serve_from_cache(self, waiter: asyncio.Future, key: str, user_id: int, positive: str,
+                                negative: str, settings: dict, priority: int,
+                                on_progress: Optional[ProgressListener] = None):
+        result = await image_cache.get(key)
+        if result is None:
+            # Запись исчезла из кэша - генерируем как обычно
+            queued = self._enqueue(key, user_id, positive, negative, settings, priority, on_progress)
+            waiter.add_done_callback(lambda f: queued.cancel() if f.cancelled() else None)
+            try:
+                result = await queued
+            except asyncio.CancelledError:
+                return
+        if not waiter.done():
+            waiter.set_result(result)
+
+    def _jobs_ahead(self, priority: int, user_id: int, index: int) -> int:
+        """
+        Сколько задач будет выдано раньше index-й задачи пользователя в полосе priority
+        (без учета группировки по модели). Пользователь, которого нет в полосе, встает в конец круга.
+        """
+        ahead = 0
+        for lane_priority in sorted(self._lanes):
+            lane = self._lanes[lane_priority]
+            if lane_priority < priority:
+                ahead += sum(len(queue) for queue in lane.values())
+                continue
+            if lane_priority == priority:
+                before = True
+                for other_id, queue in lane.items():
+                    if other_id == user_id:
+                        # Свои более ранние задачи тоже идут раньше
+                        ahead += index
+                        before = False
+                        continue
+                    # По кругу: стоящие раньше в круге успевают на один раунд больше
+                    ahead += min(len(queue), index + 1 if before else index)
+            break
+        return ahead
+
+    def _promote(self, job: GenerationJob, user_id: int, priority: int):
+        """
+        Присоединившийся запрос не должен ждать дольше, чем ждал бы собственную задачу:
+        если в своей очереди (или полосе) он получил бы ее раньше, задача переезжает туда.
+        """
+        if job.user_id == user_id and job.priority <= priority:
+            return
+        old_lane = self._lanes[job.priority]
+        old_queue = old_lane[job.user_id]
+        current = self._jobs_ahead(job.priority, job.user_id, old_queue.index(job))
+        own_queue = self._lanes.get(priority, {}).get(user_id, ())
+        candidate = self._jobs_ahead(priority, user_id, len(own_queue))
+        if priority >= job.priority and candidate >= current:
+            return
+        old_queue.remove(job)
+        if not old_queue:
+            del old_lane[job.user_id]
+        job.user_id = user_id
+        job.priority = min(job.priority, priority)
+        self._lanes.setdefault(job.priority, OrderedDict()).setdefault(user_id, deque()).append(job)
+
+    def _take(self, lane: "OrderedDict[int, Deque[GenerationJob]]", user_id: int) -> GenerationJob:
+        """Снимает голову очереди пользователя и отправляет его в конец круга."""
+        queue = lane[user_id]
+        job = queue.popleft()
+        if queue:
+            lane.move_to_end(user_id)
+        else:
+            del lane[user_id]
+        return job
+
+    def _requeue(self, job: GenerationJob):
+        """Возвращает задачу в начало очереди пользователя (после сбоя бэкенда)."""
+        job.running = False
+        lane = self._lanes.setdefault(job.priority, OrderedDict())
+        lane.setdefault(job.user_id, deque()).appendleft(job)
+        lane.move_to_end(job.user_id, last=False)
+        self._wakeup.set()
+
+    def _forget(self, job: GenerationJob):
+        if self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+
+    def _purge_cancelled(self):
+        """Убирает из голов очередей задачи, которые уже никто не ждет."""
+        for lane in self._lanes.values():
+            for user_id in list(lane):
+                queue = lane[user_id]
+                while queue and queue[0].is_abandoned():
+                    self._forget(queue.popleft())
+                if not queue:
+                    del lane[user_id]
+
+    def _pop_next(self, loaded_models: set) -> Optional[GenerationJob]:
+        """
+        Берет следующую задачу: сначала старшие полосы, внутри полосы - по кругу между пользователями.
+        Внутри окна из affinity_window пользователей предпочитается задача на модели, уже загруженной
+        на свободном бэкенде, чтобы не гонять чекпоинты туда-обратно. Задача, прождавшая max_wait,
+        идет вне очереди.
+        """
+        self._purge_cancelled()
+        lanes = [(priority, self._lanes[priority]) for priority in sorted(self._lanes) if self._lanes[priority]]
+        if not lanes:
+            return None
+
+        # Защита от голодания: самая старая голова очереди, если ждет слишком долго
+        now = time.monotonic()
+        oldest_lane, oldest_user = None, None
+        for _, lane in lanes:
+            for user_id, queue in lane.items():
+                if oldest_lane is None or queue[0].enqueued_at < oldest_lane[oldest_user][0].enqueued_at:
+                    oldest_lane, oldest_user = lane, user_id
+        if now - oldest_lane[oldest_user][0].enqueued_at >= self.max_wait:
+            return self._take(oldest_lane, oldest_user)
+
+        # Группировка по модели в пределах окна справедливости старшей полосы
+        _, lane = lanes[0]
+        if loaded_models:
+            for position, (user_id, queue) in enumerate(lane.items()):
+                if position >= self.affinity_window:
+                    break
+                if queue[0].settings.get("model_name") in loaded_models:
+                    return self._take(lane, user_id)
+
+        return self._take(lane, next(iter(lane)))
+
+    async def _dispatch(self):
+        """Раздает задачи по свободным слотам бэкендов."""
+        while True:
+            if self.pool.has_healthy() and not self.pool.has_capacity():
+                await self.pool.wait_for_change()
+                continue
+            grace = self.pool.outage_grace_left()
+            if not self.pool.has_healthy() and grace > 0:
+                # Все бэкенды лежат недавно: очередь ждет восстановления, а не сбрасывается
+                try:
+                    await asyncio.wait_for(self.pool.wait_for_change(), grace)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job = self._pop_next(self.pool.free_models())
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not self.pool.has_healthy():
+                # Бэкенды лежат дольше A1111_OUTAGE_GRACE: не держим пользователей в очереди
+                self._forget(job)
+                job.resolve(None)
+                continue
+            backend = self.pool.acquire(job.settings.get("model_name"))
+            if not job.attempts:
+                QUEUE_WAIT.observe(time.monotonic() - job.enqueued_at, job.priority)
+            job.running = True
+            task = job.task = asyncio.create_task(self._run(job, backend))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, job: GenerationJob, backend: Backend):
+        progress_monitor.watch(backend.url, job)
+        try:
+            # /interrupt прерывает любой рендер бэкенда, поэтому шлем его, только если задача там одна
+            result = await generate_image(job.positive, job.negative, job.settings,
+                                          base_url=backend.url, outputs_dir=backend.outputs_dir,
+                                          interrupt_on_cancel=backend.concurrency == 1)
+        except asyncio.CancelledError:
+            # Все отменили запрос или бот останавливается: новые запросы не должны присоединяться
+            self._forget(job)
+            for waiter in job.waiters:
+                waiter.cancel()
+            raise
+        except BackendUnavailableError as e:
+            self.pool.mark_failed(backend)
+            job.attempts += 1
+            if job.attempts <= len(self.pool.backends) and not job.is_abandoned():
+                # Отдаем задачу другому бэкенду (или этому же после восстановления), не теряя ее место в очереди
+                print(f"Задача пользователя {job.user_id} переносится на другой бэкенд: {e}")
+                self._requeue(job)
+                return
+            print(f"Ошибка в задаче генерации пользователя {job.user_id}: {e}")
+            result = None
+        except Exception as e:
+            print(f"Ошибка в задаче генерации пользователя {job.user_id}: {e}")
+            result = None
+        finally:
+            progress_monitor.unwatch(backend.url, job)
+            self.pool.release(backend)
+        self._forget(job)
+        job.resolve(result)
+        if result is None or result.seed < 0:
+            return
+        key = job.key
+        if int(job.settings.get("seed", -1)) < 0:
+            # Случайный seed кэшируем под фактическим: повтор отдаст ту же картинку тем, кто ее уже видел
+            key = get_request_key(job.positive, job.negative, dict(job.settings, seed=result.seed))
+            for user_id in job.members:
+                self._remember_seed(user_id, job.key, result.seed)
+        await image_cache.put(key, result)
+
+    def _remember_seed(self, user_id: int, key: str, seed: int):
+        self._replay_seeds[(user_id, key)] = seed
+        self._replay_seeds.move_to_end((user_id, key))
+        while len(self._replay_seeds) > self.max_replay_seeds:
+            self._replay_seeds.popitem(last=False)
+
+    def get_queue_position(self, user_id: int) -> Optional[int]:
+        """
+        Позиция ближайшей задачи пользователя в общей очереди (1 - следующая),
+        включая чужие задачи, к которым присоединился его запрос.
+        None, если у пользователя нет ожидающих задач.
+        """
+        best = None
+        for priority, lane in self._lanes.items():
+            for owner_id, queue in lane.items():
+                # В очереди одного владельца дальше первой подходящей задачи смотреть незачем
+                index = next((i for i, job in enumerate(queue) if user_id in job.members), None)
+                if index is not None:
+                    position = self._jobs_ahead(priority, owner_id, index) + 1
+                    best = position if best is None else min(best, position)
+        return best
+
+    def queue_depth(self) -> Dict[int, int]:
+        """Число ожидающих задач в каждой приоритетной полосе."""
+        return {priority: sum(len(queue) for queue in lane.values()) for priority, lane in self._lanes.items()}
+
+    def pending_count(self, user_id: int) -> int:
+        """Количество ожидающих задач пользователя."""
+        return sum(len(lane.get(user_id, ())) for lane in self._lanes.values())
+
+    async def shutdown(self):
+        """Останавливает раздачу задач и отменяет все ожидающие и выполняющиеся задачи."""
+        tasks = [task for task in (self._dispatcher, *self._running, *self._cache_tasks) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        # В _inflight лежат и ожидающие в очереди, и прерванные выполняющиеся задачи
+        for job in self._inflight.values():
+            for waiter in job.waiters:
+                waiter.cancel()
+        self._lanes.clear()
+        self._inflight.clear()
+
+
+scheduler = GenerationScheduler(
+    backend_pool,
+    affinity_window=getattr(config, "MODEL_AFFINITY_WINDOW", 8),
+    max_wait=getattr(config, "MODEL_AFFINITY_MAX_WAIT", 120.0),
+)
+
+metrics.Gauge("generation_queue_depth", "Задачи в очереди генерации по приоритетным полосам.", ["priority"],
+              collect=lambda: {(priority,): depth for priority, depth in scheduler.queue_depth().items()})
+metrics.Gauge("generation_running", "Задачи, выполняющиеся на бэкендах.", collect=lambda: len(scheduler._running))
+# Склеивание одинаковых запросов (single-flight) считается попаданием
+metrics.register_cache("coalescing", lambda: (scheduler.stats["coalesced"],
+                                              scheduler.stats["submitted"] - scheduler.stats["coalesced"]))
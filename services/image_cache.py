@@ -0,0 +1,135 @@
+# services/image_cache.py
+import asyncio
+import json
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import config
+from services import metrics
+from services.a1111_api_service import GenerationResult
+
+BASE_DIR = Path(__file__).parent.parent
+CACHE_DIR = Path(getattr(config, "IMAGE_CACHE_DIR", BASE_DIR / "data" / "image_cache"))
+MAX_CACHE_BYTES = int(getattr(config, "IMAGE_CACHE_MAX_MB", 1024)) * 1024 * 1024
+
+
+class ImageCache:
+    """
+    Дисковый кэш готовых изображений с адресацией по ключу запроса
+    (канонический хэш txt2img) и вытеснением по LRU при превышении размера.
+    Рядом с картинкой <key>.png лежит <key>.json с seed и прочими метаданными.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # ключ -> размер на диске; порядок = от самого давнего использования к свежему
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _scan(self):
+        """Читает индекс с диска; порядок LRU берется из mtime файлов."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for image_path in self.directory.glob("*.png"):
+            stat = image_path.stat()
+            entries.append((stat.st_mtime, image_path.stem, stat.st_size))
+        return [(key, size) for _, key, size in sorted(entries)]
+
+    def _apply_index(self, entries):
+        for key, size in entries:
+            self._index[key] = size
+            self._total_bytes += size
+        self._loaded = True
+
+    async def load(self):
+        """Строит индекс в отдельном потоке (при старте бота), чтобы обход папки не стопорил event loop."""
+        if not self._loaded:
+            entries = await asyncio.to_thread(self._scan)
+            if not self._loaded:
+                self._apply_index(entries)
+
+    def contains(self, key: str) -> bool:
+        if not self._loaded:
+            # Запасной путь, если load() при старте не вызывался
+            self._apply_index(self._scan())
+        return key in self._index
+
+    def _read(self, key: str) -> Optional[GenerationResult]:
+        image_path = self.directory / f"{key}.png"
+        try:
+            image = image_path.read_bytes()
+            with open(self.directory / f"{key}.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            # Отмечаем использование, чтобы порядок LRU пережил перезапуск
+            os.utime(image_path)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return GenerationResult(image, meta.get("seed", -1), from_cache=True)
+
+    def _write(self, key: str, result: GenerationResult):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.directory / f"{key}.png.tmp"
+        if result.path is not None:
+            # Файл от A1111 на этой машине копируется средствами ОС, минуя память процесса
+            shutil.copyfile(result.path, tmp_path)
+        else:
+            tmp_path.write_bytes(result.image)
+        with open(self.directory / f"{key}.json", "w", encoding="utf-8") as f:
+            json.dump({"seed": result.seed}, f)
+        # Картинка появляется атомарно и последней: наличие .png = запись целая
+        os.replace(tmp_path, self.directory / f"{key}.png")
+
+    def _remove(self, keys: list):
+        for key in keys:
+            for suffix in (".png", ".json"):
+                try:
+                    os.remove(self.directory / f"{key}{suffix}")
+                except FileNotFoundError:
+                    pass
+
+    async def get(self, key: str) -> Optional[GenerationResult]:
+        """Возвращает изображение из кэша или None."""
+        if not self.contains(key):
+            self.stats["misses"] += 1
+            return None
+        result = await asyncio.to_thread(self._read, key)
+        if result is None:
+            # Файл пропал с диска - забываем о нем
+            self._total_bytes -= self._index.pop(key, 0)
+            self.stats["misses"] += 1
+            return None
+        self._index.move_to_end(key)
+        self.stats["hits"] += 1
+        return result
+
+    async def put(self, key: str, result: GenerationResult):
+        """Сохраняет изображение и вытесняет самые давно использованные записи сверх лимита."""
+        if not self._loaded:
+            await self.load()
+        try:
+            await asyncio.to_thread(self._write, key, result)
+        except OSError as e:
+            print(f"Не удалось сохранить изображение в кэш: {e}")
+            return
+        self._total_bytes -= self._index.pop(key, 0)
+        self._index[key] = result.size
+        self._total_bytes += result.size
+
+        evicted = []
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            old_key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(old_key)
+        if evicted:
+            self.stats["evictions"] += len(evicted)
+            await asyncio.to_thread(self._remove, evicted)
+
+
+image_cache = ImageCache(CACHE_DIR, MAX_CACHE_BYTES)
+metrics.register_cache("image", lambda: (image_cache.stats["hits"], image_cache.stats["misses"]))
@@ -0,0 +1,141 @@
+# services/image_processing.py
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple, Union
+
+import config
+from services import metrics
+from services.a1111_api_service import GenerationResult
+
+# Pillow необязателен: без него изображения отправляются в исходном PNG
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Формат, в котором изображения уходят в Telegram: "jpeg", "webp" или "png" (без перекодирования)
+IMAGE_FORMAT = getattr(config, "IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = getattr(config, "IMAGE_QUALITY", 92)
+# Сохранять ли параметры генерации (infotext A1111) в EXIF перекодированного файла
+IMAGE_KEEP_INFOTEXT = getattr(config, "IMAGE_KEEP_INFOTEXT", False)
+IMAGE_PROCESS_WORKERS = getattr(config, "IMAGE_PROCESS_WORKERS", min(2, os.cpu_count() or 1))
+# Telegram принимает превью документа не больше 320x320
+THUMBNAIL_SIZE = 320
+
+_pool: Optional[ProcessPoolExecutor] = None
+# Сбои перекодирования и превью: изображение при этом уходит исходным PNG
+stats = {"transcode": 0, "thumbnail": 0}
+
+metrics.Counter("image_processing_errors_total", "Сбои обработки изображений в пуле процессов.", ["operation"],
+                collect=lambda: {(operation,): count for operation, count in stats.items()})
+
+if Image is None and IMAGE_FORMAT != "png":
+    print("Pillow не установлен: изображения будут отправляться в PNG без перекодирования.")
+
+
+def _infotext_exif(infotext: str) -> bytes:
+    """EXIF с UserComment в той же кодировке, что пишет сам A1111."""
+    exif = Image.Exif()
+    exif.get_ifd(0x8769)[0x9286] = b"UNICODE\0" + infotext.encode("utf-16-be")
+    return exif.tobytes()
+
+
+def _open(image: Union[bytes, str]):
+    # Путь к файлу передается вместо содержимого, чтобы не пересылать мегабайты в другой процесс
+    return Image.open(image if isinstance(image, str) else io.BytesIO(image))
+
+
+def transcode(image: Union[bytes, str], image_format: str, quality: int, keep_infotext: bool) -> bytes:
+    """Перекодирует PNG в JPEG/WebP, отбрасывая метаданные (выполняется в пуле процессов)."""
+    with _open(image) as source:
+        infotext = source.info.get("parameters") if keep_infotext else None
+        converted = source.convert("RGB")
+    options = {"quality": quality}
+    if image_format == "jpeg":
+        options["optimize"] = True
+    if infotext:
+        options["exif"] = _infotext_exif(infotext)
+    output = io.BytesIO()
+    converted.save(output, format=image_format.upper(), **options)
+    return output.getvalue()
+
+
+def make_thumbnail(image: Union[bytes, str], size: int = THUMBNAIL_SIZE) -> bytes:
+    """Небольшое JPEG-превью для отправки изображения документом (выполняется в пуле процессов)."""
+    with _open(image) as source:
+        thumbnail = source.convert("RGB")
+    thumbnail.thumbnail((size, size))
+    output = io.BytesIO()
+    thumbnail.save(output, format="JPEG", quality=80)
+    return output.getvalue()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # fork из многопоточного процесса (потоки asyncio.to_thread, sqlite) может унаследовать
+        # захваченную блокировку и зависнуть, поэтому воркеры запускаются чистыми
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _pool
+
+
+def _reset_broken_pool(error: Exception):
+    # Упавший процесс ломает весь пул: следующий вызов создаст новый
+    global _pool
+    if isinstance(error, BrokenProcessPool):
+        _pool = None
+
+
+def transcoding_enabled() -> bool:
+    return Image is not None and IMAGE_FORMAT != "png"
+
+
+def _source(result: GenerationResult) -> Union[bytes, str]:
+    return str(result.path) if result.path is not None else result.image
+
+
+async def prepare_photo(result: GenerationResult) -> Tuple[bytes, str]:
+    """
+    Готовит изображение к загрузке в Telegram. Возвращает (данные, расширение файла).
+    Если перекодирование выключено или не удалось, отдается исходный PNG.
+    """
+    if not transcoding_enabled():
+        return result.image, "png"
+    loop = asyncio.get_running_loop()
+    try:
+        data = await loop.run_in_executor(
+            _get_pool(), transcode, _source(result), IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_KEEP_INFOTEXT
+        )
+    except Exception as e:
+        _reset_broken_pool(e)
+        stats["transcode"] += 1
+        print(f"Ошибка перекодирования изображения: {e}")
+        return result.image, "png"
+    return data, "jpg" if IMAGE_FORMAT == "jpeg" else IMAGE_FORMAT
+
+
+async def prepare_thumbnail(result: GenerationResult) -> Optional[bytes]:
+    """Превью для документа или None, если Pillow недоступен."""
+    if Image is None:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_pool(), make_thumbnail, _source(result), THUMBNAIL_SIZE)
+    except Exception as e:
+        _reset_broken_pool(e)
+        stats["thumbnail"] += 1
+        print(f"Ошибка построения превью: {e}")
+        return None
+
+
+async def shutdown_pool():
+    """Останавливает пул процессов (при остановке бота)."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,171 @@
+# services/metrics.py
+import bisect
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from aiohttp import web
+
+import config
+
+# Локальный адрес, на котором отдается /metrics (формат Prometheus). Без METRICS_PORT сервер не запускается.
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", None)
+
+# Границы корзин гистограмм по умолчанию, секунды: от быстрых обработчиков до долгих генераций
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Функция, которая при каждом опросе /metrics возвращает значение метрики:
+# число (метрика без меток) или {кортеж значений меток: число}
+Collector = Callable[[], Union[float, Dict[Tuple[str, ...], float]]]
+
+_registry: List["_Metric"] = []
+_runner: Optional[web.AppRunner] = None
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    """
+    Общая часть метрик. Значения хранятся в обычном словаре по кортежу меток:
+    на горячем пути это одно обращение к словарю, без блокировок (бот работает в одном потоке).
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Optional[Collector] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._collect = collect
+        self._values: Dict[tuple, float] = {}
+        _registry.append(self)
+
+    def _current(self) -> Dict[tuple, float]:
+        if self._collect is None:
+            return self._values
+        value = self._collect()
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self._current().items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик. Скорость (например, апдейтов в секунду) считает Prometheus: rate()."""
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение (глубина очереди, число активных задач). Обычно задается через collect."""
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам, из него Prometheus считает p50/p95/p99 (histogram_quantile)."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [число попаданий в каждую корзину (+Inf последней), сумма значений]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+# Кэши регистрируют функцию, возвращающую (попадания, промахи); значения читаются только при опросе
+_cache_sources: Dict[str, Callable[[], Tuple[int, int]]] = {}
+
+
+def register_cache(name: str, hits_and_misses: Callable[[], Tuple[int, int]]):
+    _cache_sources[name] = hits_and_misses
+
+
+def _cache_values(index: int) -> Dict[Tuple[str, ...], float]:
+    return {(name,): source()[index] for name, source in _cache_sources.items()}
+
+
+def _cache_ratios() -> Dict[Tuple[str, ...], float]:
+    ratios = {}
+    for name, source in _cache_sources.items():
+        hits, misses = source()
+        ratios[(name,)] = hits / (hits + misses) if hits + misses else 0.0
+    return ratios
+
+
+Counter("cache_hits_total", "Попадания в кэш.", ["cache"], collect=lambda: _cache_values(0))
+Counter("cache_misses_total", "Промахи кэша.", ["cache"], collect=lambda: _cache_values(1))
+Gauge("cache_hit_ratio", "Доля попаданий в кэш с момента запуска.", ["cache"], collect=_cache_ratios)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            # Сломанный сборщик не должен ронять всю страницу метрик
+            print(f"Ошибка при сборе метрики {metric.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_server():
+    """Запускает локальный HTTP-сервер с /metrics (при старте бота, если задан METRICS_PORT)."""
+    global _runner
+    if not METRICS_PORT or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host=METRICS_HOST, port=METRICS_PORT).start()
+    print(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,53 @@
+# services/progress_monitor.py
+import asyncio
+from typing import Dict, List
+
+import config
+from services.a1111_api_service import get_progress
+
+
+class ProgressMonitor:
+    """
+    Один опрос /sdapi/v1/progress на бэкенд, сколько бы пользователей ни ждало.
+    A1111 рендерит задачи по очереди, поэтому прогресс относится к самой ранней
+    из запущенных на бэкенде задач - ей он и отдается. Опрос идет, только пока
+    на бэкенде есть задачи.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        # URL бэкенда -> задачи в порядке запуска
+        self._jobs: Dict[str, List] = {}
+        self._pollers: Dict[str, asyncio.Task] = {}
+
+    def watch(self, base_url: str, job):
+        self._jobs.setdefault(base_url, []).append(job)
+        if base_url not in self._pollers:
+            self._pollers[base_url] = asyncio.create_task(self._poll(base_url))
+
+    def unwatch(self, base_url: str, job):
+        jobs = self._jobs.get(base_url)
+        if jobs and job in jobs:
+            jobs.remove(job)
+
+    async def _poll(self, base_url: str):
+        try:
+            while self._jobs.get(base_url):
+                data = await get_progress(base_url)
+                jobs = self._jobs.get(base_url)
+                if data and jobs:
+                    jobs[0].notify_progress(float(data.get("progress") or 0.0),
+                                            float(data.get("eta_relative") or 0.0))
+                await asyncio.sleep(self.interval)
+        finally:
+            self._pollers.pop(base_url, None)
+
+    async def stop(self):
+        tasks = list(self._pollers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._jobs.clear()
+
+
+progress_monitor = ProgressMonitor(interval=getattr(config, "PROGRESS_POLL_INTERVAL", 1.0))
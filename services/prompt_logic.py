@@ -1,7 +1,9 @@
 # services/prompt_logic.py
 import json
+import os
+from functools import lru_cache
 from itertools import product
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Set, Iterator, Optional
 from pathlib import Path
 
 # --- Определяем абсолютные пути к правильным файлам ---
@@ -9,9 +11,29 @@ BASE_DIR = Path(__file__).parent.parent
 DATA_FILE_PATH = BASE_DIR / "data" / "characters.json"
 EXAMPLE_DATA_FILE_PATH = BASE_DIR / "data" / "characters_example.json"
 
+# Кэш базы персонажей в памяти процесса. Файл перечитывается, только если
+# у него поменялись inode, mtime или размер (или его переписал save_character_data).
+_characters_cache: Optional[Dict[str, Any]] = None
+_characters_stat: Optional[Tuple] = None
+# Версия базы персонажей: только растет, меняется при каждом изменении данных
+_db_version = 0
 
-def load_character_data() -> Dict[str, Any]:
-    """Загружает данные о персонажах из JSON-файла."""
+
+def _file_stat(path: Path) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _bump_version(file_stat: Optional[Tuple[int, int, int]]):
+    # mtime файла делает версию стабильной между перезапусками, если файл не менялся
+    global _db_version
+    _db_version = max(_db_version + 1, file_stat[1] if file_stat else 0)
+
+
+def _read_character_file() -> Dict[str, Any]:
     # Загружаем основной файл
     try:
         with open(DATA_FILE_PATH, "r", encoding="utf-8") as f:
@@ -26,17 +48,94 @@ def load_character_data() -> Dict[str, Any]:
         except (FileNotFoundError, json.JSONDecodeError):
             print(f"!!! ВНИМАНИЕ: Не удалось загрузить файлы персонажей. Возвращены пустые данные.")
             return {}
-        
+
+
+def load_character_data() -> Dict[str, Any]:
+    """
+    Возвращает данные о персонажах из кэша, перечитывая JSON только при изменении файла.
+    Словарь общий для всех вызовов: перед изменением его нужно скопировать.
+    """
+    global _characters_cache, _characters_stat
+    current_stat = (_file_stat(DATA_FILE_PATH), _file_stat(EXAMPLE_DATA_FILE_PATH))
+    if _characters_cache is None or current_stat != _characters_stat:
+        _characters_cache = _read_character_file()
+        _characters_stat = current_stat
+        _bump_version(current_stat[0] or current_stat[1])
+    return _characters_cache
+
+
+def get_character_db_version() -> int:
+    """Текущая версия базы персонажей (для привязки к ней рецептов и кэшей)."""
+    load_character_data()
+    return _db_version
+
+
+class PromptCombinations:
+    """
+    Ленивый набор комбинаций промтов. Количество считается как произведение длин
+    списков тегов, а комбинация по индексу собирается на лету (смешанная система
+    счисления), поэтому полное декартово произведение никогда не хранится в памяти.
+    Порядок комбинаций совпадает с порядком itertools.product.
+    empty=True - пустой набор (ни один персонаж не найден), в нем нет ни одной комбинации.
+    """
+
+    def __init__(self, base_prompt: str, mandatory_tags: List[str],
+                 combinatorics_lists: List[List[str]], all_optional_tags: Set[str], empty: bool = False):
+        self.base_prompt = base_prompt
+        self.empty = empty
+        self.mandatory_tags = list(mandatory_tags)
+        self.combinatorics_lists = [tuple(tags) for tags in combinatorics_lists]
+        self._sorted_optional_tags = sorted(all_optional_tags)
+        self._total = 0 if empty else 1
+        for tags in self.combinatorics_lists:
+            self._total *= len(tags)
+
+    def __len__(self) -> int:
+        return self._total
+
+    def _build(self, combo: Tuple[str, ...]) -> Tuple[str, str]:
+        # Порядок тегов сохраняется, дубликаты отбрасываются
+        current_tags = list(dict.fromkeys(tag for tag in combo if tag))
+        positive_parts = [self.base_prompt] + self.mandatory_tags + current_tags
+        positive_prompt = ", ".join(filter(None, positive_parts))
+
+        if not self.combinatorics_lists:
+            return positive_prompt, ""
+        current_tags_set = set(current_tags)
+        negative_prompt = ", ".join(tag for tag in self._sorted_optional_tags if tag not in current_tags_set)
+        return positive_prompt, negative_prompt
+
+    def __getitem__(self, index: int) -> Tuple[str, str]:
+        if index < 0:
+            index += self._total
+        if not 0 <= index < self._total:
+            raise IndexError("индекс комбинации вне диапазона")
+        # Раскладываем индекс по основаниям: первый список - старший разряд, как в product()
+        combo = []
+        for tags in reversed(self.combinatorics_lists):
+            index, digit = divmod(index, len(tags))
+            combo.append(tags[digit])
+        combo.reverse()
+        return self._build(tuple(combo))
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        if self.empty:
+            return
+        for combo in product(*self.combinatorics_lists):
+            yield self._build(combo)
+
+
 # --- НОВАЯ ФУНКЦИЯ ГЕНЕРАЦИИ ДЛЯ НЕСКОЛЬКИХ ПЕРСОНАЖЕЙ ---
-def generate_prompts_for_characters(character_ids: List[str], base_prompt: str) -> List[Tuple[str, str]]:
+def generate_prompts_for_characters(character_ids: List[str], base_prompt: str) -> PromptCombinations:
     """
     Генерирует комбинации для списка персонажей, объединяя их теги.
+    Возвращает ленивый набор: len() и доступ по индексу не строят все комбинации сразу.
     """
     all_characters = load_character_data()
     selected_chars_data = [all_characters.get(cid) for cid in character_ids if cid in all_characters]
 
     if not selected_chars_data:
-        return []
+        return PromptCombinations(base_prompt, [], [], set(), empty=True)
 
     # 1. Объединяем все теги от всех персонажей
     final_mandatory_tags = []
@@ -61,44 +160,50 @@ def generate_prompts_for_characters(character_ids: List[str], base_prompt: str)
             all_optional_tags_set.update(environments)
             combinatorics_lists.append(environments + [""])
 
-    # 2. Генерируем комбинации
-    generated_prompts = []
-    
-    if not combinatorics_lists:
-        # Добавляем тег о количестве персонажей, если их больше одного
-        if len(selected_chars_data) > 1:
-            base_prompt = f"{len(selected_chars_data)}girls, " + base_prompt
-        
-        positive_parts = [base_prompt] + final_mandatory_tags
-        positive_prompt = ", ".join(filter(None, positive_parts))
-        generated_prompts.append((positive_prompt, ""))
-        return generated_prompts
-    
-    all_combinations = list(product(*combinatorics_lists))
+    # 2. Добавляем тег о количестве персонажей, если их больше одного
+    if len(selected_chars_data) > 1:
+        base_prompt = f"{len(selected_chars_data)}girls, " + base_prompt
 
-    for combo in all_combinations:
-        current_tags_set = {tag for tag in combo if tag}
-        
-        # Модифицируем базовый промт, если персонажей несколько
-        current_base_prompt = base_prompt
-        if len(selected_chars_data) > 1:
-            # Умное добавление тега о количестве персонажей
-            # (можно заменить на более сложную логику, если нужно)
-            current_base_prompt = f"{len(selected_chars_data)}girls, " + base_prompt
-            
-        positive_parts = [current_base_prompt] + final_mandatory_tags + list(current_tags_set)
-        positive_prompt = ", ".join(filter(None, positive_parts))
+    return PromptCombinations(base_prompt, final_mandatory_tags, combinatorics_lists, all_optional_tags_set)
+
+def make_prompt_recipe(character_ids: List[str], base_prompt: str) -> Dict[str, Any]:
+    """
+    Компактный рецепт набора промтов для хранения в FSM вместо самого списка.
+    Набор комбинаций по нему восстанавливается функцией resolve_prompt_recipe.
+    """
+    return {
+        "character_ids": list(character_ids),
+        "base_prompt": base_prompt,
+        "db_version": get_character_db_version(),
+    }
+
+
+@lru_cache(maxsize=256)
+def _cached_combinations(character_ids: Tuple[str, ...], base_prompt: str, db_version: int) -> PromptCombinations:
+    return generate_prompts_for_characters(list(character_ids), base_prompt)
+
+
+def resolve_prompt_recipe(recipe: Optional[Dict[str, Any]]) -> Optional[PromptCombinations]:
+    """
+    Возвращает набор комбинаций по рецепту. None, если рецепта нет или база
+    персонажей с тех пор изменилась (индексы комбинаций могли сдвинуться).
+    """
+    if not recipe or recipe.get("db_version") != get_character_db_version():
+        return None
+    return _cached_combinations(tuple(recipe["character_ids"]), recipe["base_prompt"], recipe["db_version"])
 
-        negative_tags_set = all_optional_tags_set - current_tags_set
-        negative_prompt = ", ".join(sorted(list(negative_tags_set)))
-        
-        generated_prompts.append((positive_prompt, negative_prompt))
-        
-    return generated_prompts
 
 def save_character_data(data: Dict[str, Any]):
-    """Сохраняет данные о персонажах в JSON-файл."""
+    """Сохраняет данные о персонажах в JSON-файл и сразу обновляет кэш в памяти."""
+    global _characters_cache, _characters_stat
     # Сохраняем в правильной структуре с главным ключом "characters"
     full_db = {"characters": data}
-    with open(DATA_FILE_PATH, "w", encoding="utf-8") as f:
-        json.dump(full_db, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+    tmp_path = DATA_FILE_PATH.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(full_db, f, ensure_ascii=False, indent=2)
+    # Атомарная замена: читатели никогда не увидят наполовину записанный файл
+    os.replace(tmp_path, DATA_FILE_PATH)
+
+    _characters_cache = data
+    _characters_stat = (_file_stat(DATA_FILE_PATH), _file_stat(EXAMPLE_DATA_FILE_PATH))
+    _bump_version(_characters_stat[0])
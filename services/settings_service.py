@@ -0,0 +1,105 @@
+# services/settings_service.py
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+BASE_DIR = Path(__file__).parent.parent
+SETTINGS_FILE = BASE_DIR / "data" / "settings.json"
+
+DEFAULT_SETTINGS = {"required_channel_id": None, "whitelist": {}, "bot_status": "active"}
+
+# Единственная копия настроек бота. Читается с диска один раз, дальше живет в памяти.
+_settings: Optional[dict] = None
+_dirty = False
+_wakeup: Optional[asyncio.Event] = None
+# Держится на время записи файла: остановка дожидается ее, а не опрашивает флаг
+_write_lock: Optional[asyncio.Lock] = None
+_writer_task: Optional[asyncio.Task] = None
+
+
+def _read_settings_file() -> dict:
+    try:
+        with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return json.loads(json.dumps(DEFAULT_SETTINGS))
+    except json.JSONDecodeError as e:
+        # Не затираем испорченный файл молча: откладываем его в сторону для разбора
+        broken_path = SETTINGS_FILE.with_suffix(f".corrupt-{int(time.time())}.json")
+        os.replace(SETTINGS_FILE, broken_path)
+        print(f"!!! ВНИМАНИЕ: {SETTINGS_FILE} поврежден ({e}), сохранен как {broken_path}. Используются настройки по умолчанию.")
+        return json.loads(json.dumps(DEFAULT_SETTINGS))
+
+
+def load_settings() -> dict:
+    """
+    Возвращает настройки бота из памяти, без обращения к диску.
+    Это общий словарь: изменения в нем видны сразу всем, а на диск
+    они попадают после вызова save_settings().
+    """
+    global _settings
+    if _settings is None:
+        _settings = _read_settings_file()
+        for key, value in DEFAULT_SETTINGS.items():
+            _settings.setdefault(key, json.loads(json.dumps(value)))
+    return _settings
+
+
+def _write_settings_file(payload: str):
+    # Пишем во временный файл и атомарно подменяем: файл никогда не бывает обрезан
+    tmp_path = SETTINGS_FILE.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, SETTINGS_FILE)
+
+
+async def _writer():
+    """Единственный писатель settings.json: несколько изменений подряд сливаются в одну запись."""
+    global _dirty
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        async with _write_lock:
+            while _dirty:
+                _dirty = False
+                # Снимок делаем в event loop, чтобы словарь не менялся во время сериализации
+                payload = json.dumps(load_settings(), indent=2, ensure_ascii=False)
+                try:
+                    await asyncio.to_thread(_write_settings_file, payload)
+                except OSError as e:
+                    print(f"Ошибка записи настроек: {e}")
+
+
+def save_settings():
+    """Отмечает настройки измененными и будит фонового писателя."""
+    global _dirty, _wakeup, _write_lock, _writer_task
+    _dirty = True
+    if _writer_task is None or _writer_task.done():
+        _wakeup = asyncio.Event()
+        _write_lock = asyncio.Lock()
+        _writer_task = asyncio.create_task(_writer())
+    _wakeup.set()
+
+
+async def flush_settings():
+    """Останавливает писателя и дописывает несохраненные изменения (при остановке бота)."""
+    global _dirty, _writer_task
+    if _writer_task is not None:
+        # Даем текущей записи завершиться, чтобы не писать файл из двух мест:
+        # с захваченной блокировкой писатель стоит на ожидании, а не посреди записи
+        async with _write_lock:
+            _writer_task.cancel()
+            try:
+                await _writer_task
+            except asyncio.CancelledError:
+                pass
+        _writer_task = None
+    if _dirty:
+        _dirty = False
+        payload = json.dumps(load_settings(), indent=2, ensure_ascii=False)
+        await asyncio.to_thread(_write_settings_file, payload)
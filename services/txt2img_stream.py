@@ -0,0 +1,133 @@
+# services/txt2img_stream.py
+import binascii
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# Размер блока base64 при декодировании (кратен 4)
+DECODE_BLOCK_SIZE = 256 * 1024
+
+_QUOTE, _BACKSLASH = ord('"'), ord("\\")
+_OPEN = {ord("{"), ord("[")}
+_CLOSE = {ord("}"), ord("]")}
+_COMMA = ord(",")
+
+
+class Txt2ImgStreamParser:
+    """
+    Потоковый разбор ответа /sdapi/v1/txt2img без json.loads всего тела.
+    Строки base64 из поля "images" по мере прихода складываются в отдельные
+    буферы, а остальной ответ (с пустыми строками на месте изображений) копится
+    как небольшой JSON, который разбирается, только если понадобились info или
+    parameters. Структурные символы JSON - ASCII и не встречаются внутри
+    многобайтных символов UTF-8, поэтому разбор идет прямо по байтам.
+    """
+
+    def __init__(self):
+        self.images: List[bytearray] = []
+        self._rest = bytearray()
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expecting_key = False
+        # Ключ верхнего уровня, которому принадлежит текущее значение
+        self._top_key: Optional[str] = None
+        self._key_buffer: Optional[bytearray] = None
+        # Читаемая сейчас строка base64
+        self._image: Optional[bytearray] = None
+        self._metadata: Optional[Dict[str, Any]] = None
+
+    def feed(self, chunk: bytes):
+        position, size = 0, len(chunk)
+        segment_start = 0
+        while position < size:
+            if self._image is not None:
+                # Быстрый путь: в base64 нет кавычек и экранирования, ищем конец строки целиком
+                end = chunk.find(b'"', position)
+                if end < 0:
+                    self._image += chunk[position:]
+                    return
+                self._image += chunk[position:end]
+                self.images.append(self._image)
+                self._image = None
+                self._in_string = False
+                # Закрывающая кавычка уходит в остаток вместе со следующим сегментом
+                segment_start = end
+                position = end + 1
+                continue
+
+            byte = chunk[position]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif byte == _BACKSLASH:
+                    self._escape = True
+                elif byte == _QUOTE:
+                    self._in_string = False
+                    if self._key_buffer is not None:
+                        self._top_key = self._key_buffer.decode("utf-8", "replace")
+                        self._key_buffer = None
+                        self._expecting_key = False
+                        position += 1
+                        continue
+                if self._key_buffer is not None:
+                    self._key_buffer.append(byte)
+            elif byte == _QUOTE:
+                self._in_string = True
+                if self._depth == 1 and self._expecting_key:
+                    self._key_buffer = bytearray()
+                elif self._depth == 2 and self._top_key == "images":
+                    # Начало изображения: в остаток кладем только открывающую кавычку
+                    self._rest += chunk[segment_start:position + 1]
+                    self._image = bytearray()
+            elif byte in _OPEN:
+                self._depth += 1
+                if self._depth == 1:
+                    self._expecting_key = True
+            elif byte in _CLOSE:
+                self._depth -= 1
+            elif byte == _COMMA and self._depth == 1:
+                self._expecting_key = True
+            position += 1
+
+        if self._image is None:
+            self._rest += chunk[segment_start:]
+
+    def metadata(self) -> Dict[str, Any]:
+        """Ответ без изображений (parameters, info и т.д.), разбирается при первом обращении."""
+        if self._metadata is None:
+            try:
+                self._metadata = json.loads(bytes(self._rest)) if self._rest else {}
+            except ValueError:
+                self._metadata = {}
+        return self._metadata
+
+    def info(self) -> Dict[str, Any]:
+        """Разобранное поле info (A1111 отдает его строкой с JSON внутри)."""
+        try:
+            return json.loads(self.metadata().get("info") or "{}")
+        except (ValueError, TypeError):
+            return {}
+
+
+def decode_image(image_b64: bytearray) -> Tuple[bytearray, str]:
+    """
+    Декодирует base64 блоками в заранее выделенный буфер нужного размера и
+    попутно считает хэш содержимого (выполняется в отдельном потоке).
+    """
+    padding = image_b64[-2:].count(b"=")
+    image = bytearray(len(image_b64) // 4 * 3 - padding)
+    view, source = memoryview(image), memoryview(image_b64)
+    hasher = hashlib.sha256()
+    offset = 0
+    for start in range(0, len(image_b64), DECODE_BLOCK_SIZE):
+        block = binascii.a2b_base64(source[start:start + DECODE_BLOCK_SIZE])
+        view[offset:offset + len(block)] = block
+        hasher.update(block)
+        offset += len(block)
+    view.release()
+    source.release()
+    if offset < len(image):
+        # Переносы строк внутри base64 дают меньше данных, чем оценка по длине
+        del image[offset:]
+    return image, hasher.hexdigest()
@@ -1,8 +1,17 @@
 # services/user_data_service.py
+import copy
 import json
-from typing import Dict, List
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Optional
 
-USER_SETTINGS_FILE = "data/user_settings.json"
+import config
+
+BASE_DIR = Path(__file__).parent.parent
+# Старое хранилище: весь файл целиком переписывался на каждое изменение. Теперь только импортируется.
+USER_SETTINGS_FILE = BASE_DIR / "data" / "user_settings.json"
+USER_DB_FILE = Path(getattr(config, "USER_DB_PATH", BASE_DIR / "data" / "users.db"))
 MAX_SAVED_PROMPTS = 10
 
 # Настройки по умолчанию
@@ -13,42 +22,80 @@ DEFAULT_USER_DATA = {
         "width": 512,
         "height": 768,
         "sampler_name": "DPM++ 2M Karras",
-        "model_name": None
+        "model_name": None,
+        "seed": -1,
+        # Отправлять исходный PNG документом вместо сжатой фотографии
+        "send_original": False
     },
     "saved_prompts": []
 }
 
-def _load_all_user_data() -> Dict:
-    """Загружает данные всех пользователей."""
+_connection: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _import_json_file(conn: sqlite3.Connection):
+    """Однократно переносит пользователей из user_settings.json в базу."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return
     try:
-        with open(USER_SETTINGS_FILE, "r") as f:
-            return json.load(f)
+        with open(USER_SETTINGS_FILE, "r", encoding="utf-8") as f:
+            all_data = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+        all_data = {}
+
+    rows = [
+        (int(user_id), json.dumps(data, ensure_ascii=False))
+        for user_id, data in all_data.items() if str(user_id).lstrip("-").isdigit()
+    ]
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO users (user_id, data) VALUES (?, ?)", rows)
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)", (str(len(rows)),))
+    if rows:
+        print(f"Импортировано пользователей из {USER_SETTINGS_FILE.name}: {len(rows)}")
+
+
+def _get_connection() -> sqlite3.Connection:
+    """Открывает базу пользователей в режиме WAL (один раз на процесс)."""
+    global _connection
+    if _connection is None:
+        USER_DB_FILE.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(USER_DB_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        _import_json_file(conn)
+        _connection = conn
+    return _connection
 
-def _save_all_user_data(data: Dict):
-    """Сохраняет данные всех пользователей."""
-    with open(USER_SETTINGS_FILE, "w") as f:
-        json.dump(data, f, indent=2)
 
 def get_user_data(user_id: int) -> Dict:
     """Получает полные данные пользователя (настройки и промты)."""
-    all_data = _load_all_user_data()
-    user_data = all_data.get(str(user_id))
+    with _lock:
+        row = _get_connection().execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
-    if user_data:
+    if row:
+        user_data = json.loads(row[0])
         # Убедимся, что все ключи на месте
-        user_data.setdefault("settings", DEFAULT_USER_DATA["settings"])
-        user_data.setdefault("saved_prompts", DEFAULT_USER_DATA["saved_prompts"])
+        user_data.setdefault("settings", copy.deepcopy(DEFAULT_USER_DATA["settings"]))
+        user_data.setdefault("saved_prompts", [])
         return user_data
-        
-    return DEFAULT_USER_DATA.copy()
+
+    return copy.deepcopy(DEFAULT_USER_DATA)
+
 
 def save_user_data(user_id: int, data: Dict):
-    """Сохраняет полные данные пользователя."""
-    all_data = _load_all_user_data()
-    all_data[str(user_id)] = data
-    _save_all_user_data(all_data)
+    """Сохраняет полные данные пользователя (перезаписывается только его строка)."""
+    payload = json.dumps(data, ensure_ascii=False)
+    with _lock:
+        conn = _get_connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                (user_id, payload)
+            )
 
 # --- Новые функции для управления промтами ---
 
@@ -67,4 +114,4 @@ def remove_saved_prompt(user_id: int, prompt_index: int):
     user_data = get_user_data(user_id)
     if 0 <= prompt_index < len(user_data["saved_prompts"]):
         del user_data["saved_prompts"][prompt_index]
-        save_user_data(user_id, user_data)
\ No newline at end of file
+        save_user_data(user_id, user_data)
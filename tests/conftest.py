@@ -0,0 +1,18 @@
+# tests/conftest.py
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Тестам не нужен рабочий config.py: без него подставляем минимальный,
+# адреса в нем никуда не ведут, данные пишутся только во временные папки тестов
+try:
+    import config  # noqa: F401
+except ImportError:
+    config = types.ModuleType("config")
+    config.BOT_TOKEN = "123456789:TEST"
+    config.ADMIN_IDS = []
+    config.A1111_API_URL = "http://127.0.0.1:9"
+    sys.modules["config"] = config
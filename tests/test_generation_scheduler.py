@@ -0,0 +1,245 @@
+# tests/test_generation_scheduler.py
+import asyncio
+
+import pytest
+
+from services import generation_scheduler
+from services.a1111_api_service import GenerationResult
+from services.backend_pool import Backend, BackendPool
+from services.generation_scheduler import PRIORITY_ADMIN, PRIORITY_DEFAULT, GenerationScheduler
+from services.image_cache import ImageCache
+
+SETTINGS = {"model_name": None, "seed": 5}
+
+
+class FakeA1111:
+    """Вместо A1111: запоминает порядок рендеров, рендер ждет, пока тест его не отпустит."""
+
+    def __init__(self):
+        self.rendered = []
+        self.cancelled = []
+        self.interrupt_flags = []
+        self.gates = {}
+
+    def gate(self, prompt: str) -> asyncio.Event:
+        return self.gates.setdefault(prompt, asyncio.Event())
+
+    async def generate_image(self, positive, negative, settings, base_url, outputs_dir=None,
+                             interrupt_on_cancel=False):
+        self.interrupt_flags.append(interrupt_on_cancel)
+        try:
+            if positive in self.gates:
+                await self.gates[positive].wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(positive)
+            raise
+        self.rendered.append(positive)
+        return GenerationResult(positive.encode(), int(settings.get("seed", -1)))
+
+
+@pytest.fixture
+def a1111(monkeypatch, tmp_path):
+    fake = FakeA1111()
+    monkeypatch.setattr(generation_scheduler, "generate_image", fake.generate_image)
+    monkeypatch.setattr(generation_scheduler, "image_cache", ImageCache(tmp_path / "cache", 10 * 1024 * 1024))
+    monkeypatch.setattr(generation_scheduler.progress_monitor, "watch", lambda *args: None)
+    monkeypatch.setattr(generation_scheduler.progress_monitor, "unwatch", lambda *args: None)
+    return fake
+
+
+def make_scheduler(concurrency: int = 1) -> GenerationScheduler:
+    return GenerationScheduler(BackendPool([Backend("http://backend", concurrency)]))
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+async def idle(scheduler: GenerationScheduler):
+    """Дожидается задач на бэкендах вместе с записью результата в кэш."""
+    while scheduler._running:
+        await asyncio.gather(*scheduler._running)
+
+
+def test_users_are_served_round_robin(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        futures = [scheduler.submit(user_id, f"{user_id}-{n}", "", SETTINGS)
+                   for user_id, count in ((1, 3), (2, 2), (3, 1)) for n in range(count)]
+        await asyncio.gather(*futures)
+        await scheduler.shutdown()
+
+    asyncio.run(scenario())
+    assert a1111.rendered == ["1-0", "2-0", "3-0", "1-1", "2-1", "1-2"]
+
+
+def test_higher_priority_lane_goes_first(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        a1111.gate("busy")
+        busy = scheduler.submit(9, "busy", "", SETTINGS)
+        await settle()
+        futures = [scheduler.submit(1, f"bulk-{n}", "", SETTINGS) for n in range(3)]
+        futures.append(scheduler.submit(2, "admin", "", SETTINGS, PRIORITY_ADMIN))
+        assert scheduler.get_queue_position(2) == 1
+        assert scheduler.get_queue_position(1) == 2
+        a1111.gate("busy").set()
+        await asyncio.gather(busy, *futures)
+        await scheduler.shutdown()
+
+    asyncio.run(scenario())
+    assert a1111.rendered == ["busy", "admin", "bulk-0", "bulk-1", "bulk-2"]
+
+
+def test_identical_requests_are_rendered_once(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        first = scheduler.submit(1, "same", "", SETTINGS)
+        second = scheduler.submit(2, "same", "", SETTINGS)
+        results = await asyncio.gather(first, second)
+        stats = dict(scheduler.stats)
+        await scheduler.shutdown()
+        return results, stats
+
+    (first, second), stats = asyncio.run(scenario())
+    assert a1111.rendered == ["same"]
+    assert first is second
+    assert stats == {"submitted": 2, "coalesced": 1}
+
+
+def test_joining_request_keeps_its_own_lane(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        a1111.gate("busy")
+        busy = scheduler.submit(9, "busy", "", SETTINGS)
+        await settle()
+        futures = [scheduler.submit(1, f"job-{n}", "", SETTINGS) for n in range(3)]
+        # Админ присоединяется к последней задаче чужой очереди: она переезжает в его полосу
+        futures.append(scheduler.submit(2, "job-2", "", SETTINGS, PRIORITY_ADMIN))
+        assert scheduler.get_queue_position(2) == 1
+        a1111.gate("busy").set()
+        await asyncio.gather(busy, *futures)
+        await scheduler.shutdown()
+
+    asyncio.run(scenario())
+    assert a1111.rendered == ["busy", "job-2", "job-0", "job-1"]
+
+
+def test_repeated_request_is_served_from_cache(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        first = await scheduler.submit(1, "cached", "", SETTINGS)
+        await idle(scheduler)
+        second = await scheduler.submit(2, "cached", "", SETTINGS)
+        await scheduler.shutdown()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert a1111.rendered == ["cached"]
+    assert second.from_cache and second.image == first.image
+
+
+def test_random_seed_is_replayed_only_for_the_same_user(a1111, monkeypatch):
+    seeds = iter([101, 102])
+    generate = a1111.generate_image
+
+    async def random_seed(positive, negative, settings, base_url, **kwargs):
+        result = await generate(positive, negative, settings, base_url, **kwargs)
+        if int(settings["seed"]) < 0:
+            result.seed = next(seeds)
+        return result
+
+    monkeypatch.setattr(generation_scheduler, "generate_image", random_seed)
+    settings = dict(SETTINGS, seed=-1)
+
+    async def scenario():
+        scheduler = make_scheduler()
+        first = await scheduler.submit(1, "random", "", settings)
+        await idle(scheduler)
+        replay = await scheduler.submit(1, "random", "", settings)
+        other_user = await scheduler.submit(2, "random", "", settings)
+        await scheduler.shutdown()
+        return first, replay, other_user
+
+    first, replay, other_user = asyncio.run(scenario())
+    assert (first.seed, replay.seed, other_user.seed) == (101, 101, 102)
+    assert replay.from_cache and not other_user.from_cache
+    assert a1111.rendered == ["random", "random"]
+
+
+def test_cancelled_queued_job_is_never_rendered(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        a1111.gate("busy")
+        busy = scheduler.submit(1, "busy", "", SETTINGS)
+        await settle()
+        queued = scheduler.submit(2, "queued", "", SETTINGS)
+        queued.cancel()
+        a1111.gate("busy").set()
+        await busy
+        await settle()
+        inflight = dict(scheduler._inflight)
+        await scheduler.shutdown()
+        return inflight
+
+    assert asyncio.run(scenario()) == {}
+    assert a1111.rendered == ["busy"]
+
+
+def test_running_job_is_cancelled_only_when_every_waiter_cancels(a1111):
+    async def scenario():
+        pool = BackendPool([Backend("http://backend", 1)])
+        scheduler = GenerationScheduler(pool)
+        a1111.gate("slow")
+        first = scheduler.submit(1, "slow", "", SETTINGS)
+        second = scheduler.submit(2, "slow", "", SETTINGS)
+        await settle()
+        first.cancel()
+        await settle()
+        still_running = not a1111.cancelled
+        second.cancel()
+        await settle()
+        state = still_running, pool.backends[0].active, dict(scheduler._inflight)
+        await scheduler.shutdown()
+        return state
+
+    still_running, active, inflight = asyncio.run(scenario())
+    assert still_running
+    assert a1111.cancelled == ["slow"]
+    assert a1111.interrupt_flags == [True]
+    assert active == 0
+    assert inflight == {}
+
+
+def test_interrupt_is_not_requested_on_shared_backend(a1111):
+    async def scenario():
+        scheduler = make_scheduler(concurrency=2)
+        a1111.gate("slow")
+        future = scheduler.submit(1, "slow", "", SETTINGS)
+        await settle()
+        future.cancel()
+        await settle()
+        await scheduler.shutdown()
+
+    asyncio.run(scenario())
+    assert a1111.cancelled == ["slow"]
+    assert a1111.interrupt_flags == [False]
+
+
+def test_queue_position_counts_other_users_round_robin(a1111):
+    async def scenario():
+        scheduler = make_scheduler()
+        a1111.gate("busy")
+        busy = scheduler.submit(9, "busy", "", SETTINGS)
+        await settle()
+        futures = [scheduler.submit(1, f"a-{n}", "", SETTINGS) for n in range(3)]
+        futures.append(scheduler.submit(2, "b-0", "", SETTINGS))
+        positions = scheduler.get_queue_position(1), scheduler.get_queue_position(2), scheduler.pending_count(1)
+        a1111.gate("busy").set()
+        await asyncio.gather(busy, *futures)
+        await scheduler.shutdown()
+        return positions
+
+    assert asyncio.run(scenario()) == (1, 2, 3)
+    assert a1111.rendered == ["busy", "a-0", "b-0", "a-1", "a-2"]
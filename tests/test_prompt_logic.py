@@ -0,0 +1,63 @@
+# tests/test_prompt_logic.py
+from itertools import product
+
+import pytest
+
+from services.prompt_logic import PromptCombinations
+
+LISTS = [["red", "blue", ""], ["sitting", ""], ["beach", "forest", "city", ""]]
+OPTIONAL = {"red", "blue", "sitting", "beach", "forest", "city"}
+
+
+def make_combinations(lists=LISTS, optional=OPTIONAL):
+    return PromptCombinations("1girl", ["smile"], lists, optional)
+
+
+def expected(combo, optional=OPTIONAL):
+    tags = list(dict.fromkeys(tag for tag in combo if tag))
+    positive = ", ".join(filter(None, ["1girl", "smile"] + tags))
+    negative = ", ".join(tag for tag in sorted(optional) if tag not in tags)
+    return positive, negative
+
+
+def test_len_is_product_of_list_lengths():
+    assert len(make_combinations()) == 3 * 2 * 4
+
+
+def test_indexing_matches_itertools_product():
+    combinations = make_combinations()
+    for index, combo in enumerate(product(*LISTS)):
+        assert combinations[index] == expected(combo)
+
+
+def test_iteration_matches_indexing():
+    combinations = make_combinations()
+    assert list(combinations) == [combinations[i] for i in range(len(combinations))]
+
+
+def test_negative_index_and_out_of_range():
+    combinations = make_combinations()
+    assert combinations[-1] == combinations[len(combinations) - 1]
+    with pytest.raises(IndexError):
+        combinations[len(combinations)]
+    with pytest.raises(IndexError):
+        combinations[-len(combinations) - 1]
+
+
+def test_duplicate_tags_across_lists_are_dropped():
+    combinations = make_combinations([["hat", ""], ["hat", "scarf"]], {"hat", "scarf"})
+    assert combinations[0] == ("1girl, smile, hat", "scarf")
+
+
+def test_no_optional_lists_gives_single_prompt():
+    combinations = PromptCombinations("1girl", ["smile"], [], set())
+    assert len(combinations) == 1
+    assert list(combinations) == [("1girl, smile", "")]
+
+
+def test_empty_set_has_no_combinations():
+    combinations = PromptCombinations("1girl", [], [], set(), empty=True)
+    assert len(combinations) == 0
+    assert list(combinations) == []
+    with pytest.raises(IndexError):
+        combinations[0]
@@ -0,0 +1,102 @@
+# tests/test_storage.py
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.storage import SQLiteStorage
+
+
+def key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_state_and_data_survive_reopen(tmp_path):
+    path = tmp_path / "fsm.db"
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        await storage.set_state(key(1), "GenerateFlow:viewing_results")
+        await storage.set_data(key(1), {"current_index": 3, "prompt": "x" * 1000})
+        await storage.close()
+
+        reopened = SQLiteStorage(path, flush_interval=0.01)
+        state = await reopened.get_state(key(1))
+        data = await reopened.get_data(key(1))
+        await reopened.close()
+        return state, data
+
+    state, data = asyncio.run(scenario())
+    assert state == "GenerateFlow:viewing_results"
+    assert data == {"current_index": 3, "prompt": "x" * 1000}
+
+
+def test_cleared_record_is_deleted(tmp_path):
+    path = tmp_path / "fsm.db"
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        await storage.set_data(key(1), {"a": 1})
+        await storage.flush()
+        await storage.set_data(key(1), {})
+        await storage.close()
+        return storage._read_row(storage._make_key(key(1)))
+
+    assert asyncio.run(scenario()) == (None, {})
+
+
+def test_evicted_keys_are_read_back(tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(tmp_path / "fsm.db", cache_size=2, flush_interval=0.01)
+        for user_id in range(5):
+            await storage.set_data(key(user_id), {"user": user_id})
+        assert len(storage._cache) == 2
+        # Вытесненные, но еще не записанные ключи читаются из очереди записи
+        before_flush = [await storage.get_data(key(user_id)) for user_id in range(5)]
+        await storage.flush()
+        storage._cache.clear()
+        after_flush = [await storage.get_data(key(user_id)) for user_id in range(5)]
+        await storage.close()
+        return before_flush, after_flush
+
+    before_flush, after_flush = asyncio.run(scenario())
+    expected = [{"user": user_id} for user_id in range(5)]
+    assert before_flush == expected
+    assert after_flush == expected
+
+
+def test_returned_data_is_a_copy(tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(tmp_path / "fsm.db", flush_interval=0.01)
+        data = {"items": [1]}
+        await storage.set_data(key(1), data)
+        data["items"].append(2)
+        (await storage.get_data(key(1)))["items"].append(3)
+        result = await storage.get_data(key(1))
+        await storage.close()
+        return result
+
+    assert asyncio.run(scenario()) == {"items": [1]}
+
+
+def test_concurrent_loads_share_one_read_and_keep_writes(tmp_path):
+    path = tmp_path / "fsm.db"
+
+    async def scenario():
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        await storage.set_data(key(1), {"a": 1})
+        await storage.close()
+
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        reads = []
+        read_row = storage._read_row
+        storage._read_row = lambda storage_key: reads.append(storage_key) or read_row(storage_key)
+        # Запись, сделанная пока идет чтение с диска, не должна затираться прочитанным
+        await asyncio.gather(storage.get_data(key(1)), storage.set_data(key(1), {"b": 2}),
+                             storage.set_state(key(1), "done"))
+        result = await storage.get_state(key(1)), await storage.get_data(key(1))
+        await storage.close()
+        return reads, result
+
+    reads, result = asyncio.run(scenario())
+    assert len(reads) == 1
+    assert result == ("done", {"b": 2})
@@ -0,0 +1,71 @@
+# tests/test_throttling.py
+import asyncio
+import time
+
+import pytest
+
+from bot.throttling import PRIORITY_BULK, PRIORITY_INTERACTIVE, OutboundThrottle, TokenBucket
+
+
+def test_token_bucket_delay_and_retry_after():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated_at
+    assert bucket.delay(now) == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    bucket.blocked_until = now + 3
+    assert bucket.delay(now + 1) == pytest.approx(2)
+    assert bucket.delay(now + 3) == 0
+
+
+def test_chat_bucket_limits_one_chat_only():
+    async def scenario():
+        throttle = OutboundThrottle(global_rate=100, chat_rate=1, chat_burst=1)
+        await throttle.acquire(1, PRIORITY_INTERACTIVE)
+        started = time.monotonic()
+        await throttle.acquire(2, PRIORITY_INTERACTIVE)
+        other_chat = time.monotonic() - started
+        await throttle.acquire(1, PRIORITY_INTERACTIVE)
+        same_chat = time.monotonic() - started
+        return other_chat, same_chat
+
+    other_chat, same_chat = asyncio.run(scenario())
+    assert other_chat < 0.05
+    assert same_chat >= 0.9
+
+
+def test_bulk_is_not_held_by_interactive_waiting_on_its_own_chat():
+    async def scenario():
+        throttle = OutboundThrottle()
+        throttle._chat_bucket(1).blocked_until = time.monotonic() + 2
+        interactive = asyncio.create_task(throttle.acquire(1, PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0.01)
+        started = time.monotonic()
+        await throttle.acquire(2, PRIORITY_BULK)
+        waited = time.monotonic() - started
+        interactive.cancel()
+        return waited, throttle._interactive_waiting
+
+    waited, interactive_waiting = asyncio.run(scenario())
+    assert waited < 0.05
+    assert interactive_waiting == 0
+
+
+def test_interactive_goes_before_bulk_on_global_bucket():
+    async def scenario():
+        throttle = OutboundThrottle(global_rate=20)
+        throttle.global_bucket.tokens = 0
+        order = []
+
+        async def send(chat_id, priority, name):
+            await throttle.acquire(chat_id, priority)
+            order.append(name)
+
+        bulk = asyncio.create_task(send(1, PRIORITY_BULK, "bulk"))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(send(2, PRIORITY_INTERACTIVE, "interactive"))
+        await asyncio.gather(bulk, interactive)
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive", "bulk"]
@@ -0,0 +1,62 @@
+# tests/test_txt2img_stream.py
+import base64
+import json
+import os
+
+import pytest
+
+from services.txt2img_stream import Txt2ImgStreamParser, decode_image
+
+IMAGES = [os.urandom(300), os.urandom(301), os.urandom(302)]
+INFO = {"seed": 1234, "prompt": 'a "quoted", {braced} [prompt] \\ with ", "images": ["fake"]'}
+RESPONSE = json.dumps({
+    "images": [base64.b64encode(image).decode("ascii") for image in IMAGES],
+    "parameters": {"prompt": "x", "images": ["not an image"], "steps": 20},
+    "info": json.dumps(INFO),
+}, ensure_ascii=False).encode("utf-8")
+
+
+def parse(chunks):
+    parser = Txt2ImgStreamParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser
+
+
+def check(parser):
+    assert [decode_image(image)[0] for image in parser.images] == IMAGES
+    assert parser.info() == INFO
+    assert parser.metadata()["parameters"]["images"] == ["not an image"]
+    assert parser.metadata()["images"] == ["", "", ""]
+
+
+def test_whole_body():
+    check(parse([RESPONSE]))
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64, 1000])
+def test_fixed_size_chunks(size):
+    check(parse(RESPONSE[i:i + size] for i in range(0, len(RESPONSE), size)))
+
+
+def test_every_split_point():
+    for split in range(1, len(RESPONSE)):
+        check(parse([RESPONSE[:split], RESPONSE[split:]]))
+
+
+def test_unicode_split_inside_multibyte_character():
+    body = json.dumps({"images": [base64.b64encode(IMAGES[0]).decode("ascii")],
+                       "info": json.dumps({"seed": 7, "prompt": "девушка"}, ensure_ascii=False)},
+                      ensure_ascii=False).encode("utf-8")
+    split = body.index("девушка".encode("utf-8")) + 1
+    parser = parse([body[:split], body[split:]])
+    assert parser.info() == {"seed": 7, "prompt": "девушка"}
+
+
+def test_decode_image_hash_and_line_breaks():
+    image = os.urandom(1000)
+    encoded = base64.encodebytes(image)
+    assert b"\n" in encoded
+    decoded, content_hash = decode_image(bytearray(encoded))
+    assert decoded == image
+    assert content_hash == decode_image(bytearray(base64.b64encode(image)))[1]
@@ -0,0 +1,234 @@
+# tools/a1111_stub.py
+"""
+Заглушка API Automatic1111 для локальной проверки бота без GPU.
+
+Отвечает на те же эндпоинты /sdapi/v1/*, что использует бот, и возвращает
+маленькую однотонную PNG-картинку. Несколько заглушек на разных портах
+позволяют проверить пул бэкендов:
+
+    python tools/a1111_stub.py --port 7861
+    python tools/a1111_stub.py --port 7862 --latency 3
+
+и в config.py: A1111_BACKENDS = ["http://127.0.0.1:7861", "http://127.0.0.1:7862"]
+
+Для нагрузочных тестов (benchmarks/load_test.py) можно задать задержку
+отдельных эндпоинтов, время смены чекпоинта, размер картинки и долю ошибок:
+
+    python tools/a1111_stub.py --latency 2 --endpoint-latency options=0.05 \
+        --model-switch-delay 5 --image-scale 1 --noise --failure-rate 0.02
+
+Счетчики заглушки (генерации, смены моделей, ошибки) отдает GET /stub/stats.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+MODELS = ["stub_model_a", "stub_model_b"]
+SAMPLERS = ["Euler a", "Euler", "DPM++ 2M", "DPM++ 2M Karras", "DDIM"]
+
+
+def make_png(width: int, height: int, seed: int, noise: bool = False) -> bytes:
+    """
+    Однотонная RGB-картинка, цвет зависит от seed (без Pillow). С noise=True
+    пиксели случайные: такой PNG почти не сжимается и по размеру близок к настоящим.
+    """
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    if noise:
+        raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    else:
+        color = bytes(((seed >> shift) & 0xFF for shift in (16, 8, 0)))
+        raw = (b"\x00" + color * width) * height
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+class StubState:
+    def __init__(self, latency: float, endpoint_latency: Optional[Dict[str, float]] = None,
+                 model_switch_delay: float = 0.0, image_scale: float = 1 / 8, noise: bool = False,
+                 failure_rate: float = 0.0):
+        self.latency = latency
+        # Задержка ответа остальных эндпоинтов по последней части пути ("options", "sd-models", ...)
+        self.endpoint_latency = endpoint_latency or {}
+        self.model_switch_delay = model_switch_delay
+        # Доля от запрошенных width/height, в которой рисуется картинка
+        self.image_scale = image_scale
+        self.noise = noise
+        # Вероятность, что txt2img ответит ошибкой 500
+        self.failure_rate = failure_rate
+        self.model = MODELS[0]
+        self.job_started = None
+        self.interrupted = False
+        self.lock = asyncio.Lock()
+        self.stats = {"generations": 0, "model_switches": 0, "failures": 0}
+
+    async def switch_model(self, model: str):
+        if model != self.model:
+            self.stats["model_switches"] += 1
+            await asyncio.sleep(self.model_switch_delay)
+            self.model = model
+
+
+@web.middleware
+async def endpoint_delay(request: web.Request, handler):
+    state: StubState = request.app["state"]
+    delay = state.endpoint_latency.get(request.path.rsplit("/", 1)[-1], 0.0)
+    if delay:
+        await asyncio.sleep(delay)
+    return await handler(request)
+
+
+async def txt2img(request: web.Request) -> web.Response:
+    state: StubState = request.app["state"]
+    payload = await request.json()
+    seed = int(payload.get("seed", -1))
+    if seed < 0:
+        seed = random.randint(0, 2 ** 32 - 1)
+
+    # Как и настоящий A1111, выполняем задачи строго по одной
+    async with state.lock:
+        override = payload.get("override_settings", {}).get("sd_model_checkpoint")
+        if override:
+            await state.switch_model(override)
+        if random.random() < state.failure_rate:
+            state.stats["failures"] += 1
+            return web.json_response({"error": "RuntimeError", "detail": "stub failure"}, status=500)
+        state.job_started = time.monotonic()
+        state.interrupted = False
+        try:
+            deadline = state.job_started + state.latency
+            while time.monotonic() < deadline and not state.interrupted:
+                await asyncio.sleep(0.05)
+        finally:
+            state.job_started = None
+
+    state.stats["generations"] += 1
+    width = max(1, int(int(payload.get("width", 512)) * state.image_scale))
+    height = max(1, int(int(payload.get("height", 768)) * state.image_scale))
+    image = make_png(width, height, seed, state.noise)
+    info = {"seed": seed, "prompt": payload.get("prompt", ""), "sd_model_name": state.model}
+    return web.json_response({
+        "images": [base64.b64encode(image).decode("ascii")],
+        "parameters": payload,
+        "info": json.dumps(info),
+    })
+
+
+async def get_options(request: web.Request) -> web.Response:
+    return web.json_response({"sd_model_checkpoint": f"{request.app['state'].model}.safetensors [0000000000]"})
+
+
+async def set_options(request: web.Request) -> web.Response:
+    payload = await request.json()
+    if "sd_model_checkpoint" in payload:
+        state: StubState = request.app["state"]
+        async with state.lock:
+            await state.switch_model(payload["sd_model_checkpoint"])
+    return web.json_response(None)
+
+
+async def sd_models(request: web.Request) -> web.Response:
+    return web.json_response([
+        {"title": f"{name}.safetensors [0000000000]", "model_name": name, "filename": f"{name}.safetensors"}
+        for name in MODELS
+    ])
+
+
+async def samplers(request: web.Request) -> web.Response:
+    return web.json_response([{"name": name, "aliases": [], "options": {}} for name in SAMPLERS])
+
+
+async def loras(request: web.Request) -> web.Response:
+    return web.json_response([{"name": "stub_lora", "alias": "stub_lora", "path": "stub_lora.safetensors"}])
+
+
+async def embeddings(request: web.Request) -> web.Response:
+    return web.json_response({"loaded": {"stub_embedding": {"step": None}}, "skipped": {}})
+
+
+async def progress(request: web.Request) -> web.Response:
+    state: StubState = request.app["state"]
+    if state.job_started is None:
+        return web.json_response({"progress": 0.0, "eta_relative": 0.0, "state": {"job_count": 0}})
+    elapsed = time.monotonic() - state.job_started
+    fraction = min(elapsed / state.latency, 1.0) if state.latency else 1.0
+    return web.json_response({
+        "progress": fraction,
+        "eta_relative": max(state.latency - elapsed, 0.0),
+        "state": {"job_count": 1},
+    })
+
+
+async def interrupt(request: web.Request) -> web.Response:
+    request.app["state"].interrupted = True
+    return web.json_response(None)
+
+
+async def empty(request: web.Request) -> web.Response:
+    return web.json_response(None)
+
+
+async def stub_stats(request: web.Request) -> web.Response:
+    state: StubState = request.app["state"]
+    return web.json_response({**state.stats, "model": state.model})
+
+
+def create_app(latency: float = 1.0, **options) -> web.Application:
+    """options - остальные параметры StubState (endpoint_latency, model_switch_delay, ...)."""
+    app = web.Application(client_max_size=16 * 1024 * 1024, middlewares=[endpoint_delay])
+    app["state"] = StubState(latency, **options)
+    app.router.add_post("/sdapi/v1/txt2img", txt2img)
+    app.router.add_get("/sdapi/v1/options", get_options)
+    app.router.add_post("/sdapi/v1/options", set_options)
+    app.router.add_get("/sdapi/v1/sd-models", sd_models)
+    app.router.add_post("/sdapi/v1/refresh-checkpoints", empty)
+    app.router.add_get("/sdapi/v1/samplers", samplers)
+    app.router.add_get("/sdapi/v1/loras", loras)
+    app.router.add_post("/sdapi/v1/refresh-loras", empty)
+    app.router.add_get("/sdapi/v1/embeddings", embeddings)
+    app.router.add_get("/sdapi/v1/progress", progress)
+    app.router.add_post("/sdapi/v1/interrupt", interrupt)
+    app.router.add_get("/stub/stats", stub_stats)
+    return app
+
+
+def parse_endpoint_latency(values: List[str]) -> Dict[str, float]:
+    """["options=0.05", "progress=0.01"] -> {"options": 0.05, "progress": 0.01}"""
+    result = {}
+    for value in values:
+        name, _, seconds = value.partition("=")
+        result[name.strip().rsplit("/", 1)[-1]] = float(seconds)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка API Automatic1111")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--latency", type=float, default=1.0, help="время генерации одной картинки, с")
+    parser.add_argument("--endpoint-latency", action="append", default=[], metavar="NAME=SECONDS",
+                        help="задержка эндпоинта, например options=0.05 (можно повторять)")
+    parser.add_argument("--model-switch-delay", type=float, default=0.0, help="время загрузки другого чекпоинта, с")
+    parser.add_argument("--image-scale", type=float, default=1 / 8, help="размер картинки относительно запрошенного")
+    parser.add_argument("--noise", action="store_true", help="несжимаемые картинки реалистичного размера")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="доля txt2img, завершающихся ошибкой 500")
+    args = parser.parse_args()
+    app = create_app(
+        args.latency,
+        endpoint_latency=parse_endpoint_latency(args.endpoint_latency),
+        model_switch_delay=args.model_switch_delay,
+        image_scale=args.image_scale,
+        noise=args.noise,
+        failure_rate=args.failure_rate,
+    )
+    web.run_app(app, host=args.host, port=args.port)